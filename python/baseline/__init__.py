@@ -3,6 +3,8 @@ from baseline.w2v import *
 from baseline.confusion import *
 from baseline.data import *
 from baseline.reader import *
+from baseline.dataset import *
+from baseline.profiling import *
 from baseline.progress import *
 from baseline.reporting import *
 from baseline.model import *
@@ -1,13 +1,36 @@
-import random
 import numpy as np
 import math
+import copy
+import threading
+import multiprocessing
+import mmap
+import traceback
+from six.moves import queue
 
 
 class DataFeed(object):
+    """Batches, indexed from `0` to `steps - 1`
 
+    If `world_size` is more than 1, this feed is one of `world_size` data-parallel replicas, and iterating
+    visits only its `rank`'s share of each epoch's batches: every `world_size`-th batch of the epoch order,
+    starting at `rank`.  Every replica draws the epoch order from the same `seed`, so the shares are disjoint
+    and reshuffled each epoch.  Batches left over after an equal split are dropped for that epoch
+
+    The feed keeps track of where it is, so that an interrupted job can save `state_dict()` along with its
+    model, and `load_state_dict()` it into a new feed over the same data to carry on from the next batch.
+    Shuffles are drawn from the feed's own `rand`, seeded from `np.random` when the feed is created
+    """
     def __init__(self):
         self.steps = 0
         self.shuffle = False
+        self.rank = 0
+        self.world_size = 1
+        self.seed = 0
+        self.epoch = 0
+        self.position = 0
+        self.rand = np.random.RandomState(np.random.randint(2**31 - 1))
+        self._epoch_state = None
+        self._resume = 0
 
     def _batch(self, i):
         pass
@@ -15,89 +38,492 @@ class DataFeed(object):
     def __getitem__(self, i):
         return self._batch(i)
 
-    def __iter__(self):
-        shuffle = np.random.permutation(np.arange(self.steps)) if self.shuffle else np.arange(self.steps)
+    def _random(self):
+        """The random number generator for this epoch, seeded the same way on every replica if sharded"""
+        if self.world_size == 1:
+            return self.rand
+        return np.random.RandomState(self.seed + self.epoch)
+
+    def _shuffled(self, rand):
+        """The order to visit all of the batches in for one epoch"""
+        return rand.permutation(np.arange(self.steps)) if self.shuffle else np.arange(self.steps)
+
+    def _order(self):
+        """The order to visit this replica's batches in for one epoch"""
+        # Everything needed to draw this same order again, if the epoch is resumed
+        self._epoch_state = {'epoch': self.epoch, 'rand': self.rand.get_state()}
+        order = self._shuffled(self._random())
+        self.epoch += 1
+        if self.world_size > 1:
+            order = order[self.rank:len(order) - len(order) % self.world_size:self.world_size]
+        return order
+
+    def _epoch(self):
+        """Start an epoch, or carry on with the one `load_state_dict()` restored
+
+        :return: The batches still to visit.  Count each off in `position` as it is handed out
+        """
+        start, self._resume = self._resume, 0
+        order = self._order()
+        if start >= len(order):
+            # The restored epoch had already finished, so move on to the next one
+            start = 0
+            order = self._order()
+        self.position = start
+        return order[start:]
+
+    def state_dict(self):
+        """Where this feed is: the epoch, how many of its batches were handed out, and the random state it
+        was drawn from
+
+        :return: A picklable dictionary
+        """
+        if self._epoch_state is None:
+            return {'epoch': self.epoch, 'position': 0, 'rand': self.rand.get_state()}
+        return dict(self._epoch_state, position=self.position)
+
+    def load_state_dict(self, state):
+        """Restore a `state_dict()`, so that the next iteration carries on from the batch after the last
+        one handed out.  The feed must be over the same data, with the same options
+
+        :param state: The dictionary returned by `state_dict()`
+        :return: None
+        """
+        self.epoch = state['epoch']
+        self.rand.set_state(state['rand'])
+        self._epoch_state = None
+        self._resume = state['position']
 
-        for i in range(self.steps):
-            si = shuffle[i]
+    def __iter__(self):
+        for si in self._epoch():
+            self.position += 1
             yield self._batch(si)
 
     def __len__(self):
-        return self.steps
+        return self.steps // self.world_size
 
 
-class ExampleDataFeed(DataFeed):
+class PrefetchDataFeed(DataFeed):
+    """Wrap any `DataFeed`, building the next `prefetch` batches on a background thread while the current one is used
+
+    The epoch's batch order is chosen up front, exactly as the wrapped feed would choose it
+    """
+    def __init__(self, feed, prefetch=2):
+        super(PrefetchDataFeed, self).__init__()
+        self.feed = feed
+        self.steps = feed.steps
+        self.shuffle = feed.shuffle
+        self.world_size = feed.world_size
+        self.prefetch = prefetch
+
+    def _batch(self, i):
+        return self.feed._batch(i)
+
+    def _epoch(self):
+        return self.feed._epoch()
+
+    def state_dict(self):
+        return self.feed.state_dict()
+
+    def load_state_dict(self, state):
+        self.feed.load_state_dict(state)
+
+    def __iter__(self):
+        order = self._epoch()
+        batches = queue.Queue(maxsize=self.prefetch)
+        done = object()
+        stop = threading.Event()
+
+        def put(item):
+            # Give up if the consumer stopped iterating, rather than blocking on a full queue forever
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fill():
+            try:
+                for si in order:
+                    if not put((self._batch(si), None)):
+                        return
+                put((done, None))
+            except Exception as e:
+                put((done, e))
+
+        thread = threading.Thread(target=fill)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                batch, error = batches.get()
+                if error is not None:
+                    raise error
+                if batch is done:
+                    break
+                # Only count the batches handed out, not the ones built ahead, so a saved state resumes correctly
+                self.feed.position += 1
+                yield batch
+        finally:
+            stop.set()
+
+
+def bucket_edges(lengths, nbuckets):
+    """Choose bucket boundaries so that each bucket holds about the same number of examples
+
+    :param lengths: The length of each example
+    :param nbuckets: The number of buckets wanted.  There may be fewer, if many examples have the same length
+    :return: A sorted array of bucket edges, the last of which is the max length
+    """
+    lengths = np.sort(lengths)
+    quantiles = np.ceil(np.arange(1, nbuckets + 1) * len(lengths) / float(nbuckets)).astype(np.int64) - 1
+    return np.unique(lengths[quantiles])
+
+
+class BucketSampler(object):
+    """Group examples into buckets of similar length, and batches within each bucket
+
+    Each example goes in the first bucket whose edge is at least its length, so a batch never
+    needs to be padded beyond its bucket's edge.  If some examples are longer than the last edge, their
+    max length is added as an edge.  Every bucket's last batch may be short.
+
+    With `max_tokens`, batches are not `batchsz` examples, but as many as fit in `max_tokens` padded cells
+    (batch size times `width` if given, else times the bucket edge, or without buckets, the batch max length)
+    """
+    def __init__(self, lengths, batchsz, edges=None, shuffle=False, max_tokens=None, width=None):
+        """
+        :param lengths: The length of each example, by position
+        :param batchsz: The batch size, unless `max_tokens` is given
+        :param edges: Either a list of bucket edges, the number of buckets to derive with `bucket_edges`,
+            or `None` for no buckets
+        :param shuffle: Shuffle the examples within each bucket each epoch
+        :param max_tokens: If given, the most padded cells allowed in a batch
+        :param width: The width every batch is padded to, if batches are not trimmed to their edge or max length
+        """
+        self.lengths = np.asarray(lengths)
+        if edges is None:
+            self.edges = [None]
+            self.buckets = [np.arange(len(self.lengths))]
+        else:
+            if np.isscalar(edges):
+                edges = bucket_edges(self.lengths, edges)
+            self.edges = np.unique(edges)
+            if self.lengths.max() > self.edges[-1]:
+                self.edges = np.append(self.edges, self.lengths.max())
+            bucket = np.searchsorted(self.edges, self.lengths)
+            self.buckets = [np.where(bucket == b)[0] for b in range(len(self.edges))]
+            self.edges = [int(edge) for edge in self.edges]
+        self.batchsz = batchsz
+        self.shuffle = shuffle
+        self.max_tokens = max_tokens
+        self.width = width
+
+    def _pack(self, positions, edge):
+        # Shortest first, so that without an edge, each batch's width is the length of its last example
+        positions = positions[np.argsort(self.lengths[positions], kind='mergesort')]
+        if self.width is not None:
+            widths = np.full(len(positions), self.width)
+        elif edge is None:
+            widths = self.lengths[positions]
+        else:
+            widths = np.full(len(positions), edge)
+        batches = []
+        start = 0
+        for end in range(1, len(positions)):
+            if (end + 1 - start) * widths[end] > self.max_tokens:
+                batches.append(positions[start:end])
+                start = end
+        batches.append(positions[start:])
+        return batches
+
+    def batches(self, rand=np.random):
+        """Cut the buckets into batches
+
+        :param rand: The random number generator to shuffle the buckets with
+        :return: A list of (positions, edge) tuples, one per batch, where `edge` is `None` without buckets
+        """
+        batches = []
+        for edge, positions in zip(self.edges, self.buckets):
+            if len(positions) == 0:
+                continue
+            if self.shuffle:
+                positions = rand.permutation(positions)
+            if self.max_tokens is not None:
+                batches += [(batch, edge) for batch in self._pack(positions, edge)]
+            else:
+                batches += [(positions[start:start + self.batchsz], edge)
+                            for start in range(0, len(positions), self.batchsz)]
+        return batches
+
+
+def _shared_view(buf, dtype, shape):
+    dtype = np.dtype(dtype)
+    return np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _batch_worker(feed, buffers, tasks, results):
+    """Build the batches named by `tasks` into the shared `buffers`, until given `None`"""
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        j, slot, positions, siglen = task
+        try:
+            info = []
+            for buf, vec in zip(buffers[slot], feed._batch_at(positions, siglen, feed.trim)):
+                if vec.nbytes > len(buf):
+                    raise ValueError('Batch of shape %s does not fit its %d byte buffer' % (vec.shape, len(buf)))
+                _shared_view(buf, vec.dtype, vec.shape)[...] = vec
+                info.append((vec.shape, vec.dtype.str))
+            results.put((j, slot, info, None))
+        except Exception:
+            results.put((j, slot, None, traceback.format_exc()))
+
 
+class ExampleDataFeed(DataFeed):
+    """Batches of examples from one of the `*Examples` containers below
+
+    By default, batch `i` holds the `batchsz` examples starting at position `i * batchsz`.  If `buckets`
+    is given (a list of bucket edges, or a number of buckets), a `BucketSampler` groups the examples by
+    length instead.  With `trim`, each batch is only padded to its bucket's edge, or without buckets, to its
+    longest example.  If `max_tokens` is given, batches hold as many examples as fit in that many padded cells,
+    counted at the width they are actually padded to, so their sizes vary.
+
+    If `world_size` is more than 1, the feed is sharded as described in `DataFeed`.  The examples are then put
+    back in file order (undoing any shuffle or sort done by the container), so that every replica agrees on
+    which examples each batch holds.  Use `shuffle` and `buckets` to randomize and group them instead.
+
+    If `workers` is more than 1, iterating builds batches in that many processes, each writing into one of
+    a ring of shared memory buffers.  The batches are numpy views of those buffers, so a batch is only valid
+    until the next one is asked for.  The order is the same as without workers
+    """
     def __init__(self, examples, batchsz, **kwargs):
         super(ExampleDataFeed, self).__init__()
 
+        self.rank = int(kwargs.get('rank', 0))
+        self.world_size = int(kwargs.get('world_size', 1))
+        self.seed = int(kwargs.get('seed', 0))
+        if not 0 <= self.rank < self.world_size:
+            raise ValueError('rank must be in [0, %d), got %d' % (self.world_size, self.rank))
+        if self.world_size > 1:
+            examples = examples.subset(np.argsort(examples.order))
         self.examples = examples
         self.batchsz = batchsz
         self.shuffle = bool(kwargs.get('shuffle', False))
-        self.vec_alloc = kwargs.get('vec_alloc', np.zeros)
-        self.vec_shape = kwargs.get('vec_shape', np.shape)
         self.src_vec_trans = kwargs.get('src_vec_trans', None)
         self.steps = int(math.floor(len(self.examples)/float(batchsz)))
         self.trim = bool(kwargs.get('trim', False))
+        self.buckets = kwargs.get('buckets', None)
+        self.max_tokens = kwargs.get('max_tokens', None)
+        self._make_sampler()
+        self.workers = int(kwargs.get('workers', 1))
+
+    def _make_sampler(self):
+        self.sampler = None
+        if self.buckets is not None or self.max_tokens is not None:
+            # Untrimmed batches are padded to the full width whatever their bucket, so that is what they cost
+            width = None if self.trim or self.max_tokens is None else self._padded_width()
+            self.sampler = BucketSampler(self.examples.example_lengths(), self.batchsz, self.buckets, self.shuffle,
+                                         self.max_tokens, width)
+            self.batches = self.sampler.batches(self._random())
+            self.steps = len(self.batches)
+
+    def state_dict(self):
+        """Also holds the order of the examples, which the container may have shuffled when it was loaded"""
+        return dict(super(ExampleDataFeed, self).state_dict(), order=np.array(self.examples.order))
+
+    def load_state_dict(self, state):
+        if not np.array_equal(state['order'], self.examples.order):
+            self.examples = copy.copy(self.examples)
+            self.examples.order = np.asarray(state['order'])
+            self._make_sampler()
+        super(ExampleDataFeed, self).load_state_dict(state)
+
+    def _batch_at(self, positions, siglen, trim):
+        pass
 
+    def _padded_width(self):
+        """The width of an untrimmed batch, from the first vector of a one example batch"""
+        return int(self._batch_at(np.arange(1), None, False)[0].shape[1])
+
+    def _batch(self, i):
+        positions, siglen = self._positions(i)
+        return self._batch_at(positions, siglen, self.trim)
+
+    def __iter__(self):
+        if self.workers > 1:
+            return self._iter_workers()
+        return super(ExampleDataFeed, self).__iter__()
+
+    def _shared_buffers(self, nslots):
+        # Any batch fits in the space of the largest batch size padded out to mxlen
+        batchsz = max(len(positions) for positions, _ in self.batches) if self.sampler is not None else self.batchsz
+        largest = self._batch_at(np.arange(batchsz) % len(self.examples), None, False)
+        return [[multiprocessing.RawArray('b', vec.nbytes) for vec in largest] for _ in range(nslots)]
+
+    def _iter_workers(self):
+        order = self._epoch()
+        # Two slots per worker, so each can build a batch while its last one is waiting to be used
+        nslots = 2 * self.workers
+        buffers = self._shared_buffers(nslots)
+        tasks = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_batch_worker, args=(self, buffers, tasks, results))
+                 for _ in range(self.workers)]
+        for proc in procs:
+            proc.daemon = True
+            proc.start()
+
+        def send(j):
+            positions, siglen = self._positions(order[j])
+            tasks.put((j, j % nslots, positions, siglen))
+
+        try:
+            for j in range(min(nslots, len(order))):
+                send(j)
+            ready = {}
+            for j in range(len(order)):
+                # Batches can finish out of order, so hold on to any that arrive early
+                while j not in ready:
+                    k, slot, info, error = results.get()
+                    if error is not None:
+                        raise RuntimeError('Batch worker failed:\n%s' % error)
+                    ready[k] = (slot, info)
+                slot, info = ready.pop(j)
+                self.position += 1
+                yield tuple(_shared_view(buf, dtype, shape) for buf, (shape, dtype) in zip(buffers[slot], info))
+                # Asking for the next batch means this one is done with, so its slot can be refilled
+                if j + nslots < len(order):
+                    send(j + nslots)
+        finally:
+            for _ in procs:
+                tasks.put(None)
+            for proc in procs:
+                proc.join(1)
+                if proc.is_alive():
+                    proc.terminate()
+
+    def _shuffled(self, rand):
+        if self.sampler is not None and self.shuffle:
+            self.batches = self.sampler.batches(rand)
+        return super(ExampleDataFeed, self)._shuffled(rand)
+
+    def _positions(self, i):
+        """The positions of the examples in batch `i`, and the width to pad them to (or `None`)"""
+        if self.sampler is None:
+            return np.arange(i * self.batchsz, (i + 1) * self.batchsz) % len(self.examples), None
+        positions, edge = self.batches[i]
+        return positions, edge if self.trim else None
+
+
+def index_dtype(size):
+    """The narrowest integer type that can hold the indices `0` to `size - 1`
+
+    Examples store their ids in this type, and are widened to int64 only when a batch is made
+    """
+    for dtype in (np.uint8, np.uint16, np.int32):
+        if size <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.int64
+
+
+def ragged_index(starts, lengths):
+    """Index the elements of ragged rows stored back to back in a flat array
+
+    :param starts: Where each row starts in the flat array
+    :param lengths: How many elements to take from each row
+    :return: The row, the column and the flat array index of every element taken
+    """
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return rows, cols, np.repeat(starts, lengths) + cols
 
 
 class SeqLabelExamples(object):
+    """Classification examples, as one `(N, width)` array of word ids and an array of labels
+
+    Shuffling just permutes the `order` index, and a batch is a single gather of rows from `x` and `y`
+    """
 
     SEQ = 0
     LABEL = 1
 
-    def __init__(self, example_list, do_shuffle=True):
-        self.example_list = example_list
+    def __init__(self, x, y, lengths=None, do_shuffle=True):
+        """
+        :param x: The word ids of every example, padded to the same width
+        :param y: The label of every example
+        :param lengths: Optionally, how much of the width of each `x` is used, for bucketing
+        :param do_shuffle: Shuffle the examples
+        """
+        self.x = x
+        self.y = y
+        self.lengths = np.full(len(y), x.shape[1], dtype=np.int64) if lengths is None else lengths
+        self.order = np.arange(len(y))
         if do_shuffle:
-            random.shuffle(self.example_list)
+            self.order = np.random.permutation(self.order)
 
     def __getitem__(self, i):
-        ex = self.example_list[i]
-        return ex[SeqLabelExamples.SEQ], ex[SeqLabelExamples.LABEL]
+        k = self.order[i]
+        return self.x[k].astype(np.int64), np.int64(self.y[k])
 
     def __len__(self):
-        return len(self.example_list)
+        return len(self.order)
 
     def width(self):
-        x, y = self.example_list[0]
-        return len(x)
-
-    def batch(self, start, batchsz, vec_alloc=np.empty):
-        siglen = self.width()
-        xb = vec_alloc((batchsz, siglen), dtype=np.int)
-        yb = vec_alloc((batchsz), dtype=np.int)
-        sz = len(self.example_list)
-        idx = start * batchsz
-        for i in range(batchsz):
-            if idx >= sz: idx = 0
-            x, y = self.example_list[idx]
-            xb[i] = x
-            yb[i] = y
-            idx += 1
-
-        return xb, yb
-        
+        return self.x.shape[1]
+
+    def example_lengths(self):
+        return self.lengths[self.order]
+
+    def subset(self, positions):
+        """A view of some of these examples, sharing the same storage
+
+        :param positions: Positions in the current (shuffled) order
+        :return: A `SeqLabelExamples`
+        """
+        examples = copy.copy(self)
+        examples.order = self.order[positions]
+        return examples
+
+    def batch(self, start, batchsz):
+        sz = len(self.order)
+        return self.batch_at(np.arange(start * batchsz, (start + 1) * batchsz) % sz)
+
+    def batch_at(self, positions, siglen=None, trim=False):
+        """Gather the examples at `positions`, keeping only the first `siglen` of each `x` if given, else the
+        batch max length if `trim`"""
+        order = self.order[positions]
+        if siglen is None:
+            siglen = int(self.lengths[order].max()) if trim else self.width()
+        return self.x[order, :siglen].astype(np.int64), self.y[order].astype(np.int64)
+
     @staticmethod
     def valid_split(data, splitfrac=0.15):
-        numinst = len(data.examples)
+        numinst = len(data)
         heldout = int(math.floor(numinst * (1-splitfrac)))
-        heldout_ex = data.example_list[1:heldout]
-        rest_ex = data.example_list[heldout:]
-        return SeqLabelExamples(heldout_ex), SeqLabelExamples(rest_ex)
+        return data.subset(np.arange(heldout)), data.subset(np.arange(heldout, numinst))
 
 class SeqLabelDataFeed(ExampleDataFeed):
 
     def __init__(self, examples, batchsz, **kwargs):
         super(SeqLabelDataFeed, self).__init__(examples, batchsz, **kwargs)
 
-    def _batch(self, i):
-        x, y = self.examples.batch(i, self.batchsz, self.vec_alloc)
+    def _batch_at(self, positions, siglen, trim):
+        x, y = self.examples.batch_at(positions, siglen, trim)
         if self.src_vec_trans is not None:
             x = self.src_vec_trans(x)
         return x, y
 
 class SeqWordCharTagExamples(object):
+    """Tagging examples, stored ragged
+
+    The words and tags of all sentences are concatenated into flat arrays, with `offsets[i]:offsets[i+1]`
+    giving the tokens of sentence `i`.  The characters of all tokens are concatenated the same way, with
+    `char_offsets[t]:char_offsets[t+1]` giving the characters of token `t`.  Nothing is padded to
+    `mxlen` x `maxw` until a batch is made.
+    """
 
     SEQ_WORD = 0
     SEQ_CHAR = 1
@@ -105,62 +531,73 @@ class SeqWordCharTagExamples(object):
     SEQ_LEN = 3
     SEQ_ID = 4
 
-    def __init__(self, example_list, do_shuffle=True, do_sort=True):
-        self.example_list = example_list
+    def __init__(self, words, chars, tags, offsets, char_offsets, ids, mxlen, maxw, do_shuffle=True, do_sort=True):
+        self.words = words
+        self.chars = chars
+        self.tags = tags
+        self.offsets = offsets
+        self.char_offsets = char_offsets
+        self.ids = ids
+        self.lengths = np.diff(offsets)
+        self.mxlen = mxlen
+        self.maxw = maxw
+        # Rather than moving the data around, shuffling and sorting just permute this
+        self.order = np.arange(len(ids))
         if do_shuffle:
-            random.shuffle(self.example_list)
+            self.order = np.random.permutation(self.order)
         if do_sort:
-            self.example_list = sorted(self.example_list, key=lambda x: x[SeqWordCharTagExamples.SEQ_LEN])
+            self.order = self.order[np.argsort(self.lengths[self.order], kind='mergesort')]
 
     def __getitem__(self, i):
-        ex = self.example_list[i]
-        return ex[SeqWordCharTagExamples.SEQ_WORD], ex[SeqWordCharTagExamples.SEQ_CHAR], \
-               ex[SeqWordCharTagExamples.SEQ_TAG], ex[SeqWordCharTagExamples.SEQ_LEN], \
-               ex[SeqWordCharTagExamples.SEQ_ID]
+        xs, xs_ch, ys, length, ids = self._pad(self.order[i:i+1], self.mxlen)
+        return xs[0], xs_ch[0], ys[0], length[0], ids[0]
 
     def __len__(self):
-        return len(self.example_list)
-
-    def batch(self, start, batchsz, trim=False, vec_alloc=np.empty, vec_shape=np.shape):
-        ex = self.example_list[start]
-        siglen, maxw = vec_shape(ex[SeqWordCharTagExamples.SEQ_CHAR])
-        xs_ch = vec_alloc((batchsz, siglen, maxw), dtype=np.int)
-        xs = vec_alloc((batchsz, siglen), dtype=np.int)
-        ys = vec_alloc((batchsz, siglen), dtype=np.int)
-        ids = vec_alloc((batchsz), dtype=np.int)
-        length = vec_alloc((batchsz), dtype=np.int)
-        sz = len(self.example_list)
-        idx = start * batchsz
-
-        max_src_len = 0
-
-        for i in range(batchsz):
-            if idx >= sz: idx = 0
-
-            ex = self.example_list[idx]
-            xs[i] = ex[SeqWordCharTagExamples.SEQ_WORD]
-            xs_ch[i] = ex[SeqWordCharTagExamples.SEQ_CHAR]
-            ys[i] = ex[SeqWordCharTagExamples.SEQ_TAG]
-            length[i] = ex[SeqWordCharTagExamples.SEQ_LEN]
-            max_src_len = max(max_src_len, length[i])
-            ids[i] = ex[SeqWordCharTagExamples.SEQ_ID]
-            idx += 1
-
-        if trim:
-            xs = xs[:,0:max_src_len]
-            xs_ch = xs_ch[:,0:max_src_len,:]
-            ys = ys[:,0:max_src_len]
-
-        return xs, xs_ch, ys, length, ids
-
+        return len(self.order)
+
+    def example_lengths(self):
+        return self.lengths[self.order]
+
+    def subset(self, positions):
+        """A view of some of these examples, sharing the same storage
+
+        :param positions: Positions in the current (shuffled, sorted) order
+        :return: A `SeqWordCharTagExamples`
+        """
+        examples = copy.copy(self)
+        examples.order = self.order[positions]
+        return examples
+
+    def _pad(self, order, siglen):
+        batchsz = len(order)
+        xs_ch = np.zeros((batchsz, siglen, self.maxw), dtype=np.int64)
+        xs = np.zeros((batchsz, siglen), dtype=np.int64)
+        ys = np.zeros((batchsz, siglen), dtype=np.int64)
+        rows, cols, tokens = ragged_index(self.offsets[order], np.minimum(self.lengths[order], siglen))
+        xs[rows, cols] = self.words[tokens]
+        ys[rows, cols] = self.tags[tokens]
+        char_starts = self.char_offsets[tokens]
+        token_idx, char_cols, chars = ragged_index(char_starts, self.char_offsets[tokens + 1] - char_starts)
+        xs_ch[rows[token_idx], cols[token_idx], char_cols] = self.chars[chars]
+
+        return xs, xs_ch, ys, self.lengths[order], self.ids[order]
+
+    def batch(self, start, batchsz, trim=False):
+        sz = len(self.order)
+        return self.batch_at(np.arange(start * batchsz, (start + 1) * batchsz) % sz, trim)
+
+    def batch_at(self, positions, trim=False, siglen=None):
+        """Pad the examples at `positions` to `siglen` if given, else the batch max length if `trim`, else `mxlen`"""
+        order = self.order[positions]
+        if siglen is None:
+            siglen = int(self.lengths[order].max()) if trim else self.mxlen
+        return self._pad(order, siglen)
 
     @staticmethod
     def valid_split(data, splitfrac=0.15):
-        numinst = len(data.examples)
+        numinst = len(data)
         heldout = int(math.floor(numinst * (1-splitfrac)))
-        heldout_ex = data.example_list[1:heldout]
-        rest_ex = data.example_list[heldout:]
-        return SeqLabelExamples(heldout_ex), SeqLabelExamples(rest_ex)
+        return data.subset(np.arange(heldout)), data.subset(np.arange(heldout, numinst))
 
 
 class SeqWordCharLabelDataFeed(ExampleDataFeed):
@@ -168,62 +605,81 @@ class SeqWordCharLabelDataFeed(ExampleDataFeed):
     def __init__(self, examples, batchsz, **kwargs):
         super(SeqWordCharLabelDataFeed, self).__init__(examples, batchsz, **kwargs)
 
-    def _batch(self, i):
-        return self.examples.batch(i, self.batchsz, self.trim, self.vec_alloc, self.vec_shape)
+    def _batch_at(self, positions, siglen, trim):
+        return self.examples.batch_at(positions, trim, siglen)
 
 
 class Seq2SeqExamples(object):
+    """Source/target pairs, stored ragged
+
+    All the sources are concatenated into one flat array, with `src_offsets[i]:src_offsets[i+1]` giving
+    source `i`, and the targets (including `<GO>` and `<EOS>`) the same way.  Pairs are only padded
+    to `mxlen` (or to the batch max lengths when trimming) in `batch()`.
+    """
 
     SRC = 0
     TGT = 1
     SRC_LEN = 2
     TGT_LEN = 3
 
-    def __init__(self, example_list, do_shuffle=True, do_sort=True):
-        self.example_list = example_list
+    def __init__(self, src, tgt, src_offsets, tgt_offsets, mxlen, do_shuffle=True, do_sort=True):
+        self.src = src
+        self.tgt = tgt
+        self.src_offsets = src_offsets
+        self.tgt_offsets = tgt_offsets
+        self.src_lens = np.diff(src_offsets)
+        self.tgt_lens = np.diff(tgt_offsets)
+        self.mxlen = mxlen
+        # Rather than moving the data around, shuffling and sorting just permute this
+        self.order = np.arange(len(self.src_lens))
         if do_shuffle:
-            random.shuffle(self.example_list)
+            self.order = np.random.permutation(self.order)
         if do_sort:
-            self.example_list = sorted(self.example_list, key=lambda x: x[Seq2SeqExamples.SRC_LEN])
+            self.order = self.order[np.argsort(self.src_lens[self.order], kind='mergesort')]
 
     def __getitem__(self, i):
-        ex = self.example_list[i]
-        return ex[Seq2SeqExamples.SRC], ex[Seq2SeqExamples.TGT], ex[Seq2SeqExamples.SRC_LEN], ex[Seq2SeqExamples.TGT_LEN]
+        srcs, tgts, src_lens, tgt_lens = self._pad(self.order[i:i+1], self.mxlen, self.mxlen)
+        return srcs[0], tgts[0], src_lens[0], tgt_lens[0]
 
     def __len__(self):
-        return len(self.example_list)
-
-    def batch(self, start, batchsz, trim=False, vec_alloc=np.zeros):
-        sig_src_len = len(self.example_list[0][Seq2SeqExamples.SRC])
-        sig_tgt_len = len(self.example_list[0][Seq2SeqExamples.TGT])
-
-        srcs = vec_alloc((batchsz, sig_src_len), dtype=np.int)
-        tgts = vec_alloc((batchsz, sig_tgt_len), dtype=np.int)
-        src_lens = vec_alloc((batchsz), dtype=np.int)
-        tgt_lens = vec_alloc((batchsz), dtype=np.int)
-        sz = len(self.example_list)
-
-        max_src_len = 0
-        max_tgt_len = 0
-
-        idx = start * batchsz
-        for i in range(batchsz):
-            if idx >= sz: idx = 0
-        
-            example = self.example_list[idx]
-            srcs[i] = example[Seq2SeqExamples.SRC]
-            tgts[i] = example[Seq2SeqExamples.TGT]
-            src_lens[i] = example[Seq2SeqExamples.SRC_LEN]
-            tgt_lens[i] = example[Seq2SeqExamples.TGT_LEN]
-            max_src_len = max(max_src_len, src_lens[i])
-            max_tgt_len = max(max_tgt_len, tgt_lens[i])
-            idx += 1
-
+        return len(self.order)
+
+    def example_lengths(self):
+        return np.maximum(self.src_lens, self.tgt_lens)[self.order]
+
+    def subset(self, positions):
+        """A view of some of these examples, sharing the same storage
+
+        :param positions: Positions in the current (shuffled, sorted) order
+        :return: A `Seq2SeqExamples`
+        """
+        examples = copy.copy(self)
+        examples.order = self.order[positions]
+        return examples
+
+    def _pad(self, order, src_width, tgt_width):
+        batchsz = len(order)
+        srcs = np.zeros((batchsz, src_width), dtype=np.int64)
+        tgts = np.zeros((batchsz, tgt_width), dtype=np.int64)
+        rows, cols, idx = ragged_index(self.src_offsets[order], np.minimum(self.src_lens[order], src_width))
+        srcs[rows, cols] = self.src[idx]
+        rows, cols, idx = ragged_index(self.tgt_offsets[order], np.minimum(self.tgt_lens[order], tgt_width))
+        tgts[rows, cols] = self.tgt[idx]
+
+        return srcs, tgts, self.src_lens[order], self.tgt_lens[order]
+
+    def batch(self, start, batchsz, trim=False):
+        sz = len(self.order)
+        return self.batch_at(np.arange(start * batchsz, (start + 1) * batchsz) % sz, trim)
+
+    def batch_at(self, positions, trim=False, siglen=None):
+        """Pad the pairs at `positions` to `siglen` if given, else the batch max lengths if `trim`, else `mxlen`"""
+        order = self.order[positions]
+        if siglen is not None:
+            return self._pad(order, siglen, siglen)
         if trim:
-            srcs = srcs[:,0:max_src_len]
-            tgts = tgts[:,0:max_tgt_len]
-
-        return srcs, tgts, src_lens, tgt_lens
+            return self._pad(order, int(self.src_lens[order].max()), int(self.tgt_lens[order].max()))
+        return self._pad(order, self.mxlen, self.mxlen)
 
 
 def reverse_2nd(vec):
@@ -235,37 +691,110 @@ class Seq2SeqDataFeed(ExampleDataFeed):
     def __init__(self, examples, batchsz, **kwargs):
         super(Seq2SeqDataFeed, self).__init__(examples, batchsz, **kwargs)
 
-    def _batch(self, i):
-        src, tgt, src_len, tgt_len = self.examples.batch(i, self.batchsz, self.trim, self.vec_alloc)
+    def _batch_at(self, positions, siglen, trim):
+        src, tgt, src_len, tgt_len = self.examples.batch_at(positions, trim, siglen)
         if self.src_vec_trans is not None:
             src = self.src_vec_trans(src)
         return src, tgt, src_len, tgt_len
 
 
+class LazyExamples(object):
+    """Examples that stay in their file until a batch needs them
+
+    The file is memory-mapped, and the text of example `k` is the bytes `starts[k]:ends[k]`.  To make a batch,
+    `parse` is called with the texts of its examples and their indices, and returns one of the containers
+    above holding just those examples, in that order.  That container then makes the batch, so this can stand
+    in for any of them.  Only the index is shuffled and sorted
+    """
+    def __init__(self, filename, starts, ends, lengths, parse, do_shuffle=True, do_sort=False):
+        """
+        :param filename: The file the examples are in
+        :param starts: The byte offset of each example
+        :param ends: The byte offset just past each example
+        :param lengths: The length of each example, for sorting and bucketing
+        :param parse: A function from a list of example texts and an array of their indices to a container
+        :param do_shuffle: Shuffle the examples
+        :param do_sort: Sort the examples by length
+        """
+        self.filename = filename
+        self.starts = starts
+        self.ends = ends
+        self.lengths = lengths
+        self.parse = parse
+        self.data = None
+        self.order = np.arange(len(starts))
+        if do_shuffle:
+            self.order = np.random.permutation(self.order)
+        if do_sort:
+            self.order = self.order[np.argsort(self.lengths[self.order], kind='mergesort')]
+
+    def __getstate__(self):
+        # Each process maps the file for itself
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def _examples(self, order):
+        if self.data is None:
+            with open(self.filename, 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        texts = [self.data[self.starts[k]:self.ends[k]].decode('utf-8') for k in order.tolist()]
+        return self.parse(texts, order)
+
+    def __getitem__(self, i):
+        return self._examples(self.order[i:i+1])[0]
+
+    def __len__(self):
+        return len(self.order)
+
+    def example_lengths(self):
+        return self.lengths[self.order]
+
+    def subset(self, positions):
+        """A view of some of these examples, sharing the same index
+
+        :param positions: Positions in the current (shuffled, sorted) order
+        :return: A `LazyExamples`
+        """
+        examples = copy.copy(self)
+        examples.order = self.order[positions]
+        return examples
+
+    def batch(self, start, batchsz, *args):
+        sz = len(self.order)
+        return self.batch_at(np.arange(start * batchsz, (start + 1) * batchsz) % sz, *args)
+
+    def batch_at(self, positions, *args, **kwargs):
+        """Parse the examples at `positions`, and batch them with the same arguments as the parsed container"""
+        order = self.order[positions]
+        return self._examples(order).batch_at(np.arange(len(order)), *args, **kwargs)
+
+
 # This one is a little different at the moment
 class SeqWordCharDataFeed(DataFeed):
+    """Language model batches over one long stream of word ids
 
-    def __init__(self, x, xch, nbptt, batchsz, maxw):
+    The characters are not stored per running word, but once per vocabulary entry in `word_chars`,
+    and gathered for the words of each batch
+    """
+    def __init__(self, x, word_chars, nbptt, batchsz, maxw):
         super(SeqWordCharDataFeed, self).__init__()
         num_examples = x.shape[0]
         rest = num_examples // batchsz
         self.steps = rest // nbptt
-        self.stride_ch = nbptt * maxw
         trunc = batchsz * rest
 
         print('Truncating from %d to %d' % (num_examples, trunc))
         self.x = x[:trunc].reshape((batchsz, rest))
-        xch = xch.flatten()
-        trunc = batchsz * rest * maxw
-
-        print('Truncated from %d to %d' % (xch.shape[0], trunc))
-        self.xch = xch[:trunc].reshape((batchsz, rest * maxw))
+        self.word_chars = word_chars[:, :maxw]
         self.nbptt = nbptt
         self.batchsz = batchsz
         self.wsz = maxw
+
     def _batch(self, i):
-        return self.x[:, i*self.nbptt:(i+1)*self.nbptt].reshape((self.batchsz, self.nbptt)), \
-              self.xch[:, i*self.stride_ch:(i+1)*self.stride_ch].reshape((self.batchsz, self.nbptt, self.wsz)), \
-              self.x[:, i*self.nbptt+1:(i+1)*self.nbptt+1].reshape((self.batchsz, self.nbptt))
+        x = self.x[:, i*self.nbptt:(i+1)*self.nbptt].reshape((self.batchsz, self.nbptt))
+        return x.astype(np.int64), \
+              self.word_chars[x].astype(np.int64), \
+              self.x[:, i*self.nbptt+1:(i+1)*self.nbptt+1].reshape((self.batchsz, self.nbptt)).astype(np.int64)
 
 
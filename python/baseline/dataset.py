@@ -0,0 +1,170 @@
+import baseline.data
+import numpy as np
+from collections import Counter
+import codecs
+import json
+import os
+
+# Bump this whenever the layout of the arrays written below changes
+DATASET_VERSION = 5
+
+# The arrays stored for each task.  For classify these are the stacked storage of SeqLabelExamples,
+# for tagger and seq2seq they are the ragged storage of SeqWordCharTagExamples and Seq2SeqExamples
+TASK_COLUMNS = {
+    'classify': ('x', 'y', 'lengths'),
+    'tagger': ('words', 'chars', 'tags', 'offsets', 'char_offsets', 'ids'),
+    'seq2seq': ('src', 'tgt', 'src_offsets', 'tgt_offsets'),
+    'lm': ('x', 'word_chars'),
+}
+
+
+def _column_file(dirname, split, name):
+    return os.path.join(dirname, '%s.%s.npy' % (split, name))
+
+
+def _write_column(filename, rows):
+    if isinstance(rows, np.ndarray):
+        np.save(filename, rows)
+        return
+    first = np.asarray(rows[0])
+    # Fill the file row by row so we never hold a second, stacked copy of the data in memory
+    out = np.lib.format.open_memmap(filename, mode='w+', dtype=first.dtype, shape=(len(rows),) + first.shape)
+    for i, row in enumerate(rows):
+        out[i] = row
+    out.flush()
+    del out
+
+
+def write_dataset(outdir, task, splits, vocabs, indices, label2index=None, params=None):
+    """Write preprocessed, indexed data out in a format that `Dataset` can memory-map
+
+    :param outdir: The directory to write into, created if needed
+    :param task: One of the keys of `TASK_COLUMNS`
+    :param splits: A dictionary from split name (e.g. `train`) to either a list of example tuples or a tuple
+        of arrays (or lists of rows), one per column in `TASK_COLUMNS[task]`
+    :param vocabs: A dictionary of the `Counter`s returned by the reader's `build_vocab`, keyed by name
+    :param indices: A dictionary of the word to index maps the data was indexed with, keyed by name
+    :param label2index: The reader's label map, if any
+    :param params: Any reader parameters needed to interpret the arrays (e.g. `mxlen`)
+    :return: None
+    """
+    if task not in TASK_COLUMNS:
+        raise ValueError('Unknown task %s' % task)
+    columns = TASK_COLUMNS[task]
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    split_info = {}
+    for split, data in splits.items():
+        if isinstance(data, tuple):
+            arrays = data
+        else:
+            arrays = [[ex[j] for ex in data] for j in range(len(columns))]
+
+        for name, rows in zip(columns, arrays):
+            _write_column(_column_file(outdir, split, name), rows)
+        if task == 'tagger':
+            num_examples = len(arrays[-1])
+        elif task == 'seq2seq':
+            num_examples = len(arrays[-1]) - 1
+        else:
+            num_examples = len(arrays[0])
+        split_info[split] = {'num_examples': num_examples}
+
+    with codecs.open(os.path.join(outdir, 'vocab.json'), encoding='utf-8', mode='w') as f:
+        json.dump({'vocabs': vocabs, 'indices': indices}, f, ensure_ascii=False)
+
+    meta = {
+        'version': DATASET_VERSION,
+        'task': task,
+        'splits': split_info,
+        'label2index': label2index if label2index is not None else {},
+        'params': params if params is not None else {}
+    }
+    with codecs.open(os.path.join(outdir, 'meta.json'), encoding='utf-8', mode='w') as f:
+        json.dump(meta, f, indent=2, ensure_ascii=False)
+
+
+class Dataset(object):
+    """A dataset written by `write_dataset` (or `preprocess.py`)
+
+    The arrays are memory-mapped, so opening the dataset and creating feeds from it costs next to nothing,
+    regardless of the size of the corpus.
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        with codecs.open(os.path.join(dirname, 'meta.json'), encoding='utf-8', mode='r') as f:
+            meta = json.load(f)
+
+        version = meta.get('version', 0)
+        if version != DATASET_VERSION:
+            raise ValueError('Dataset %s has version %d, but this code reads version %d.  Re-run preprocess.py'
+                             % (dirname, version, DATASET_VERSION))
+
+        self.task = meta['task']
+        self.splits = meta['splits']
+        self.label2index = meta['label2index']
+        self.params = meta['params']
+
+        with codecs.open(os.path.join(dirname, 'vocab.json'), encoding='utf-8', mode='r') as f:
+            vocab = json.load(f)
+        self.vocabs = {k: Counter(v) for k, v in vocab['vocabs'].items()}
+        self.indices = vocab['indices']
+
+    def check_index(self, name, index):
+        """Make sure that a vocabulary (e.g. from `Word2VecModel`) matches what the data was indexed with
+
+        :param name: The name of the index (e.g. `word`)
+        :param index: The word to index map
+        :return: None, raises a `ValueError` if the maps differ
+        """
+        if self.indices.get(name) != index:
+            raise ValueError('The %s index does not match the one used to preprocess %s.  Re-run preprocess.py '
+                             'with the same embeddings' % (name, self.dirname))
+
+    def check_split(self, split):
+        """Make sure that the dataset has a split
+
+        :param split: The name of the split (e.g. `train`)
+        :return: None, raises a `ValueError` if it was not preprocessed
+        """
+        if split not in self.splits:
+            raise ValueError('No split %s in dataset %s' % (split, self.dirname))
+
+    def columns(self, split):
+        self.check_split(split)
+        return [np.load(_column_file(self.dirname, split, name), mmap_mode='r') for name in TASK_COLUMNS[self.task]]
+
+    def examples(self, split):
+        if self.task == 'tagger':
+            return baseline.data.SeqWordCharTagExamples(*self.columns(split),
+                                                         mxlen=self.params['max_sentence_length'],
+                                                         maxw=self.params['max_word_length'])
+        if self.task == 'seq2seq':
+            return baseline.data.Seq2SeqExamples(*self.columns(split), mxlen=self.params['max_sentence_length'])
+        if self.task == 'classify':
+            x, y, lengths = self.columns(split)
+            return baseline.data.SeqLabelExamples(x, y, lengths)
+        raise ValueError('No examples for task %s, use load()' % self.task)
+
+    def load(self, split, batchsz, shuffle=False, **kwargs):
+        """Create a `DataFeed` over one split, the same type that the task's reader would return from `load()`
+
+        :param split: The split name (e.g. `train`)
+        :param batchsz: The batch size
+        :param shuffle: Shuffle the batch order each epoch
+        :param kwargs: Passed through to the feed (e.g. `trim`, `src_vec_trans`, `buckets`).
+            For `lm`, `nbptt` is required
+        :return: A `DataFeed`
+        """
+        if self.task == 'lm':
+            x, word_chars = self.columns(split)
+            return baseline.data.SeqWordCharDataFeed(x, word_chars, kwargs['nbptt'], batchsz,
+                                                     self.params['max_word_length'])
+
+        examples = self.examples(split)
+        if self.task == 'classify':
+            return baseline.data.SeqLabelDataFeed(examples, batchsz, shuffle=shuffle, **kwargs)
+        if self.task == 'tagger':
+            return baseline.data.SeqWordCharLabelDataFeed(examples, batchsz, shuffle=shuffle, **kwargs)
+        return baseline.data.Seq2SeqDataFeed(examples, batchsz, shuffle=shuffle, **kwargs)
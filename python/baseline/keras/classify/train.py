@@ -19,18 +19,21 @@ class ClassifyTrainerKeras(EpochReportingTrainer):
 
         train_metrics = {}
         steps = len(loader)
+        total = 0
         pg = ProgressBar(steps)
         for x, y in loader:
             y = np_utils.to_categorical(y,  len(self.model.labels))
             metrics = self.model.impl.train_on_batch(x, y)
+            # Batches may differ in size, so weight each batch's metrics by its size
             for i in range(len(self.model.impl.metrics_names)):
                 name = self.model.impl.metrics_names[i]
                 name = ClassifyTrainerKeras.METRIC_REMAP.get(name, name)
-                train_metrics[name] = train_metrics.get(name, 0) + metrics[i]
+                train_metrics[name] = train_metrics.get(name, 0) + metrics[i] * len(y)
+            total += len(y)
             pg.update()
 
         for k, v in train_metrics.items():
-            train_metrics[k] /= steps
+            train_metrics[k] /= total
 
         pg.done()
         return train_metrics
@@ -38,6 +41,7 @@ class ClassifyTrainerKeras(EpochReportingTrainer):
     def _test(self, loader):
         test_metrics = {}
         steps = len(loader)
+        total = 0
         pg = ProgressBar(steps)
         for x, y in loader:
             y = np_utils.to_categorical(y, len(self.model.labels))
@@ -45,12 +49,13 @@ class ClassifyTrainerKeras(EpochReportingTrainer):
             for i in range(len(self.model.impl.metrics_names)):
                 name = self.model.impl.metrics_names[i]
                 name = ClassifyTrainerKeras.METRIC_REMAP.get(name, name)
-                test_metrics[name] = test_metrics.get(name, 0) + metrics[i]
+                test_metrics[name] = test_metrics.get(name, 0) + metrics[i] * len(y)
+            total += len(y)
             pg.update()
         pg.done()
 
         for k, v in test_metrics.items():
-            test_metrics[k] /= steps
+            test_metrics[k] /= total
         return test_metrics
 
 
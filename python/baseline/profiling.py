@@ -0,0 +1,179 @@
+import baseline.data
+import baseline.reader
+import numpy as np
+from collections import Counter
+import math
+
+
+def length_at(lengths, percentile):
+    """The smallest length that covers at least `percentile` percent of the examples
+
+    :param lengths: The length of each example
+    :param percentile: A number in (0, 100]
+    :return: An int, the max length if `percentile` is 100
+    """
+    lengths = np.sort(lengths)
+    if len(lengths) == 0:
+        return 0
+    k = int(math.ceil(percentile * len(lengths) / 100.0)) - 1
+    return int(lengths[min(max(k, 0), len(lengths) - 1)])
+
+
+def length_histogram(lengths, nbins=10):
+    """Count the examples in `nbins` equal-width length ranges, from 0 to the max length
+
+    :return: A list of `(low, high, count)` tuples, the ranges being inclusive
+    """
+    lengths = np.asarray(lengths)
+    if len(lengths) == 0:
+        return []
+    width = max(int(math.ceil((lengths.max() + 1) / float(nbins))), 1)
+    counts = np.bincount(lengths // width)
+    return [(b * width, (b + 1) * width - 1, int(count)) for b, count in enumerate(counts)]
+
+
+def padded_cells(lengths, batchsz, mxlen=None, trim=False, edges=None, rand=None):
+    """How many cells the batches of a corpus would hold, padding included
+
+    Lengths are first truncated to `mxlen`.  Then each batch is padded either to `mxlen` (the readers' default),
+    to its longest example (`trim`, with the examples in random order) or to its bucket's edge (`edges`, batched
+    by a `BucketSampler` just as a feed would)
+
+    :param lengths: The length of each example
+    :param batchsz: The batch size
+    :param mxlen: The truncation length, the max length if `None`
+    :param trim: Pad each batch only to its longest example
+    :param edges: Bucket edges, overrides `trim`
+    :param rand: The random number generator used to order the examples for `trim`
+    :return: The number of padded cells
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if len(lengths) == 0:
+        return 0
+    mxlen = int(lengths.max()) if mxlen is None else mxlen
+    lengths = np.minimum(lengths, mxlen)
+    if edges is not None:
+        sampler = baseline.data.BucketSampler(lengths, batchsz, edges)
+        return sum(len(positions) * edge for positions, edge in sampler.batches())
+    if trim:
+        rand = np.random.RandomState(0) if rand is None else rand
+        batches = np.array_split(rand.permutation(lengths), range(batchsz, len(lengths), batchsz))
+        return sum(len(batch) * int(batch.max()) for batch in batches)
+    return len(lengths) * mxlen
+
+
+class LengthProfile(object):
+    """The lengths of one kind of sequence (sentences, source sides, words) over a corpus
+
+    Each length may carry a count, so word lengths can be profiled over a vocabulary rather than every token
+    """
+    def __init__(self, name, lengths, counts=None):
+        lengths = np.asarray(lengths, dtype=np.int64)
+        self.name = name
+        self.lengths = lengths if counts is None else np.repeat(lengths, np.asarray(counts, dtype=np.int64))
+
+    def length_at(self, percentile):
+        return length_at(self.lengths, percentile)
+
+    def waste(self, batchsz, mxlen=None, trim=False, edges=None):
+        """The fraction of the padded cells that is padding, see `padded_cells`"""
+        total = padded_cells(self.lengths, batchsz, mxlen, trim, edges)
+        if total == 0:
+            return 0.0
+        mxlen = int(self.lengths.max()) if mxlen is None else mxlen
+        return 1.0 - np.minimum(self.lengths, mxlen).sum() / float(total)
+
+    def truncated(self, mxlen):
+        """The fraction of examples longer than `mxlen`"""
+        return float((self.lengths > mxlen).mean()) if len(self.lengths) else 0.0
+
+    def report(self, nbins=10, percentiles=(50, 90, 95, 99, 99.9, 100)):
+        """A printable summary: the number of examples, some percentiles and a histogram"""
+        lines = ['%s: %d' % (self.name, len(self.lengths))]
+        lines.append('  ' + '  '.join('p%g=%d' % (p, self.length_at(p)) for p in percentiles))
+        histogram = length_histogram(self.lengths, nbins)
+        if histogram:
+            most = max(count for _, _, count in histogram)
+            for low, high, count in histogram:
+                bar = '#' * int(math.ceil(40.0 * count / most))
+                lines.append('  %6d-%-6d %9d %s' % (low, high, count, bar))
+        return '\n'.join(lines)
+
+
+def oov_rate(words, vocab):
+    """The fraction of tokens and of distinct words in `words` (a `Counter`) that are missing from `vocab`"""
+    oov = [w for w in words if w not in vocab]
+    num_tokens = sum(words.values())
+    if num_tokens == 0:
+        return 0.0, 0.0
+    return sum(words[w] for w in oov) / float(num_tokens), len(oov) / float(len(words))
+
+
+def _profile_sequences(sequences):
+    lengths = []
+    words = Counter()
+    for tokens in sequences:
+        lengths.append(len(tokens))
+        words.update(tokens)
+    return lengths, words
+
+
+def _word_profile(words, name='word length'):
+    # Word lengths are counted over every token, so the profile is weighted by each word's count
+    return LengthProfile(name, [len(w) for w in words], list(words.values()))
+
+
+def profile_classify(filename, clean_fn=None, zeropadding=0):
+    """Profile the sentence lengths of a `TSVSeqLabelReader` file, tokenized as the reader would
+
+    The lengths are the widths the reader gives each example: at least one token, plus the zero padding on both
+    sides, so they can be compared with its `mxlen` directly
+
+    :param zeropadding: The reader's `mxfiltsz`
+    :return: A tuple of a `LengthProfile` of sentence lengths and a `Counter` of tokens
+    """
+    clean_fn = baseline.reader.identity_trans_fn if clean_fn is None else clean_fn
+    with baseline.reader._open_text(filename) as f:
+        tokenize = baseline.reader.TSVSeqLabelReader.tokenize
+        lengths, words = _profile_sequences(tokenize(line, clean_fn)[1] for line in f)
+    return LengthProfile('sentence length', np.maximum(lengths, 1) + 2 * (zeropadding // 2)), words
+
+
+def profile_tagger(filename, word_trans_fn=None):
+    """Profile the sentence and word lengths of a `CONLLSeqReader` file
+
+    Word lengths are of the raw words, as the characters are indexed, while the `Counter` holds the words after
+    `word_trans_fn`, as the words are indexed
+
+    :return: A tuple of `LengthProfile`s of sentence and word lengths, and a `Counter` of words
+    """
+    txts, _ = baseline.reader.CONLLSeqReader.read_lines(filename)
+    lengths, raw = _profile_sequences(txts)
+    words = raw
+    if word_trans_fn is not None:
+        words = Counter()
+        for w, count in raw.items():
+            words[word_trans_fn(w)] += count
+    return LengthProfile('sentence length', lengths), _word_profile(raw), words
+
+
+def profile_seq2seq(reader, filename):
+    """Profile both sides of a `ParallelCorpusReader` file
+
+    :return: A tuple of `LengthProfile`s of source and target lengths, and `Counter`s of source and target words
+    """
+    pairs = list(reader._read_pairs(filename))
+    src_lengths, src_words = _profile_sequences(src for src, _ in pairs)
+    # The reader adds <GO> and <EOS> around every target
+    tgt_lengths, tgt_words = _profile_sequences(tgt for _, tgt in pairs)
+    return (LengthProfile('source length', src_lengths), LengthProfile('target length', np.array(tgt_lengths) + 2),
+            src_words, tgt_words)
+
+
+def profile_lm(filename):
+    """Profile the word lengths of a `PTBSeqReader` file
+
+    :return: A tuple of a `LengthProfile` of word lengths and a `Counter` of words
+    """
+    _, words = _profile_sequences(line.split() + ['<EOS>'] for line in baseline.reader._file_lines(filename))
+    return _word_profile(words), words
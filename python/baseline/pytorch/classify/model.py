@@ -3,6 +3,7 @@ import torch.nn as nn
 import math
 import json
 from baseline.model import Classifier
+from baseline.w2v import cow_weights, QuantizedWeights
 from baseline.pytorch.torchy import *
 import torch.backends.cudnn as cudnn
 cudnn.benchmark = True
@@ -35,10 +36,13 @@ class ConvModel(nn.Module, Classifier):
         model.labels = labels
         nc = len(labels)
         model.vocab = embeddings.vocab
-        model.lut = nn.Embedding(embeddings.vsz + 1, dsz)
-        del model.lut.weight
-        model.lut.weight = nn.Parameter(torch.FloatTensor(embeddings.weights),
-                                       requires_grad=finetune)
+        if not finetune and isinstance(embeddings.weights, QuantizedWeights):
+            model.lut = QuantizedEmbedding(embeddings.weights)
+        else:
+            model.lut = nn.Embedding(embeddings.vsz + 1, dsz)
+            del model.lut.weight
+            model.lut.weight = nn.Parameter(torch.from_numpy(cow_weights(embeddings.weights)),
+                                           requires_grad=finetune)
         model.convs = []
         for i, fsz in enumerate(filtsz):
             pad = fsz//2                
@@ -116,7 +120,7 @@ class LSTMModel(nn.Module, Classifier):
         model.lut = nn.Embedding(embeddings.vsz + 1, dsz)
         del model.lut.weight
 
-        model.lut.weight = nn.Parameter(torch.FloatTensor(embeddings.weights),
+        model.lut.weight = nn.Parameter(torch.from_numpy(cow_weights(embeddings.weights)),
                                        requires_grad=True)
 
         model.lstm = nn.LSTM(dsz, hsz, nlayers, bias=False, batch_first=True, dropout=pdrop)
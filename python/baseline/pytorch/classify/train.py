@@ -3,6 +3,7 @@ from baseline.progress import ProgressBar
 from baseline.confusion import ConfusionMatrix
 from baseline.reporting import basic_reporting
 from baseline.train import EpochReportingTrainer
+from baseline.pytorch.torchy import as_tensor
 import torch
 import torch.autograd
 
@@ -42,25 +43,29 @@ class ClassifyTrainerPyTorch(EpochReportingTrainer):
     def _test(self, loader):
         self.model.eval()
         total_loss = 0
+        total = 0
         steps = len(loader)
         pg = ProgressBar(steps)
         cm = ConfusionMatrix(self.labels)
 
         for x, y in loader:
             if type(x) == list:
-                x = [torch.autograd.Variable(item.cuda()) for item in x]
+                x = [torch.autograd.Variable(as_tensor(item).cuda()) for item in x]
             else:
-                x = torch.autograd.Variable(x.cuda())
-            y = torch.autograd.Variable(y.cuda())
+                x = torch.autograd.Variable(as_tensor(x).cuda())
+            y = torch.autograd.Variable(as_tensor(y).cuda())
             pred = self.model(x)
             loss = self.crit(pred, y)
-            total_loss += loss.data[0]
+            # Batches may differ in size, so weight each batch's mean loss by its size
+            batchsz = y.size(0)
+            total_loss += loss.data[0] * batchsz
+            total += batchsz
             _add_to_cm(cm, y, pred)
             pg.update()
         pg.done()
 
         metrics = cm.get_all_metrics()
-        metrics['avg_loss'] = total_loss/float(steps)
+        metrics['avg_loss'] = total_loss/float(total)
 
         return metrics
 
@@ -70,16 +75,19 @@ class ClassifyTrainerPyTorch(EpochReportingTrainer):
         pg = ProgressBar(steps)
         cm = ConfusionMatrix(self.labels)
         total_loss = 0
+        total = 0
         for x, y in loader:
             self.optimizer.zero_grad()
             if type(x) == list:
-                x = [torch.autograd.Variable(item.cuda()) for item in x]
+                x = [torch.autograd.Variable(as_tensor(item).cuda()) for item in x]
             else:
-                x = torch.autograd.Variable(x.cuda())
-            y = torch.autograd.Variable(y.cuda())
+                x = torch.autograd.Variable(as_tensor(x).cuda())
+            y = torch.autograd.Variable(as_tensor(y).cuda())
             pred = self.model(x)
             loss = self.crit(pred, y)
-            total_loss += loss.data[0]
+            batchsz = y.size(0)
+            total_loss += loss.data[0] * batchsz
+            total += batchsz
             loss.backward()
             _add_to_cm(cm, y, pred)
             self.optimizer.step()
@@ -87,7 +95,7 @@ class ClassifyTrainerPyTorch(EpochReportingTrainer):
         pg.done()
 
         metrics = cm.get_all_metrics()
-        metrics['avg_loss'] = total_loss/float(steps)
+        metrics['avg_loss'] = total_loss/float(total)
         return metrics
 
 
@@ -7,6 +7,7 @@ from baseline.progress import ProgressBar
 from baseline.reporting import basic_reporting
 from baseline.utils import listify
 from baseline.train import Trainer
+from baseline.pytorch.torchy import as_tensor
 
 
 class Seq2SeqTrainerPyTorch(Trainer):
@@ -35,6 +36,8 @@ class Seq2SeqTrainerPyTorch(Trainer):
             self.crit.cuda()
     
     def _wrap(self, src, tgt):
+        src = as_tensor(src)
+        tgt = as_tensor(tgt)
         dst = tgt[:,:-1]
         tgt = tgt[:,1:]
         if self.gpu:
@@ -32,6 +32,9 @@ class TaggerTrainerPyTorch(EpochReportingTrainer):
 
     def _wrap(self, x, xch, y):
 
+        x = as_tensor(x)
+        xch = as_tensor(xch)
+        y = as_tensor(y)
         if self.gpu:
             x = x.cuda()
             xch = xch.cuda()
@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 from baseline.utils import lookup_sentence
+from baseline.w2v import cow_weights, QuantizedWeights
 import torch.autograd
 import torch.nn as nn
 
@@ -126,11 +127,32 @@ def pytorch_rnn_cell(insz, hsz, rnntype, nlayers, dropout):
         rnn = StackedLSTMCell(nlayers, insz, hsz, dropout)
     return rnn
 
+class QuantizedEmbedding(nn.Module):
+    """A frozen lookup table that keeps `QuantizedWeights` as they are, and only converts the rows it looks up to floats"""
+    def __init__(self, weights):
+        super(QuantizedEmbedding, self).__init__()
+        self.embedding_dim = weights.shape[1]
+        self.register_buffer('codes', torch.from_numpy(weights.codes))
+        self.quantized = weights.scales is not None
+        if self.quantized:
+            self.register_buffer('scales', torch.from_numpy(weights.scales))
+
+    def forward(self, input):
+        flat = input.contiguous().view(-1)
+        rows = torch.autograd.Variable(self.codes).index_select(0, flat).float()
+        if self.quantized:
+            rows = rows * torch.autograd.Variable(self.scales).index_select(0, flat).unsqueeze(1)
+        return rows.view(*(list(input.size()) + [self.embedding_dim]))
+
+
 def pytorch_embedding(x2vec, finetune=True):
+    if not finetune and isinstance(x2vec.weights, QuantizedWeights):
+        return QuantizedEmbedding(x2vec.weights)
     dsz = x2vec.dsz
     lut = nn.Embedding(x2vec.vsz + 1, dsz, padding_idx=0)
     del lut.weight
-    lut.weight = nn.Parameter(torch.FloatTensor(x2vec.weights),
+    # Shared weights stay shared until the table is written to
+    lut.weight = nn.Parameter(torch.from_numpy(cow_weights(x2vec.weights)),
                               requires_grad=finetune)
     return lut
 
@@ -180,6 +202,10 @@ def tensor_reverse_2nd(tensor):
     idx = torch.LongTensor([i for i in range(tensor.size(1)-1, -1, -1)])
     return tensor.index_select(1, idx)
 
+def as_tensor(vec):
+    # Batches from baseline.data are numpy, which may be a reversed (negative stride) view
+    return torch.from_numpy(np.ascontiguousarray(vec)) if type(vec) == np.ndarray else vec
+
 def long_0_tensor_alloc(dims, dtype=None):
     lt = long_tensor_alloc(dims)
     lt.zero_()
@@ -195,6 +221,8 @@ def show_examples_pytorch(model, es, rlut1, rlut2, embed2, mxlen, sample, prob_c
     si = np.random.randint(0, len(es))
 
     src_array, tgt_array, src_len, _ = es[si]
+    src_array = as_tensor(src_array)
+    tgt_array = as_tensor(tgt_array)
 
     if max_examples > 0:
         max_examples = min(max_examples, src_array.size(0))
@@ -3,26 +3,388 @@ import numpy as np
 from collections import Counter
 import re
 import codecs
+import array
+import math
+import multiprocessing
+import functools
+import itertools
+import collections
+import os
+import mmap
+import zlib
+import gzip
+import bz2
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+# For each compressed format: how to open it as a stream, the magic bytes that start each of its members
+# (gzip) or streams (bz2, xz), and a decompressor for one of those.  Files made by parallel compressors
+# (pigz, bgzip, pbzip2, pixz) or by concatenation have many, and each can be decoded on its own
+_COMPRESSION = {
+    '.gz': (gzip.open, b'\x1f\x8b\x08', functools.partial(zlib.decompressobj, 16 + zlib.MAX_WBITS)),
+    '.bz2': (bz2.BZ2File, b'BZh', bz2.BZ2Decompressor),
+}
+if lzma is not None:
+    _COMPRESSION['.xz'] = (lzma.open, b'\xfd7zXZ\x00', lzma.LZMADecompressor)
+
+
+def _compression(filename):
+    return _COMPRESSION.get(os.path.splitext(filename)[1])
+
+
+def _open_text(filename):
+    """Open a file to read as utf-8 text, decompressing `.gz`, `.bz2` and `.xz` files as it is read"""
+    compression = _compression(filename)
+    if compression is None:
+        return codecs.open(filename, encoding='utf-8', mode='r')
+    return codecs.getreader('utf-8')(compression[0](filename, 'rb'))
 
 
 def num_lines(filename):
     lines = 0
-    with codecs.open(filename, encoding='utf-8', mode='r') as f:
+    with _open_text(filename) as f:
         for _ in f:
             lines = lines + 1
     return lines
 
 
-def _build_vocab_for_col(col, files):
+def _chunk_lines_task(task):
+    """Read the lines of a chunk in a worker, stopping once they pass `MAX_CHUNK_BYTES`
+
+    :return: The lines, and whether they are all of the chunk's lines
+    """
+    lines = []
+    size = 0
+    for line in _chunk_lines(*task):
+        lines.append(line)
+        size += len(line)
+        if size > MAX_CHUNK_BYTES:
+            return lines, False
+    return lines, True
+
+
+def _file_lines(filename, workers=1):
+    """Iterate the lines of a file
+
+    :param workers: If more than 1 and the file is compressed, decode its members in this many processes.  At most
+        two chunks per worker are decoded ahead of the line being read, and a chunk with more than `MAX_CHUNK_BYTES`
+        of text (e.g. one large member) is streamed here past that point, so memory does not grow with the file
+    """
+    if workers > 1 and _compression(filename) is not None:
+        pool = multiprocessing.Pool(workers)
+        try:
+            tasks = iter([(filename, start, end) for start, end in _byte_ranges(filename, workers)])
+            pending = collections.deque()
+            for task in itertools.islice(tasks, 2 * workers):
+                pending.append((task, pool.apply_async(_chunk_lines_task, (task,))))
+            while pending:
+                task, result = pending.popleft()
+                lines, complete = result.get()
+                for next_task in itertools.islice(tasks, 1):
+                    pending.append((next_task, pool.apply_async(_chunk_lines_task, (next_task,))))
+                for line in lines:
+                    yield line
+                if not complete:
+                    for line in itertools.islice(_chunk_lines(*task), len(lines), None):
+                        yield line
+        finally:
+            pool.terminate()
+        return
+
+    with _open_text(filename) as f:
+        for line in f:
+            yield line
+
+
+# Chunks are at most this many bytes, so a worker never holds much more than this in memory
+MAX_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def _byte_ranges(filename, workers):
+    size = os.path.getsize(filename)
+    nchunks = max(workers * 4, int(math.ceil(size / float(MAX_CHUNK_BYTES))), 1)
+    edges = np.linspace(0, size, nchunks + 1).astype(np.int64).tolist()
+    return [(start, end) for start, end in zip(edges[:-1], edges[1:]) if end > start]
+
+
+# Compressed data is fed to a decompressor this many bytes at a time
+DECODE_BLOCK_BYTES = 1024 * 1024
+
+
+_DECODE_ERRORS = (zlib.error, IOError, EOFError, ValueError) + ((lzma.LZMAError,) if lzma is not None else ())
+
+
+def _member_blocks(data, start, decompressor, ends):
+    """Generate the decompressed blocks of the member (or stream) that starts at `start`
+
+    Where the next member starts is appended to `ends` once this one is done.  Corrupt or truncated data raises
+    a `ValueError`
+    """
+    d = decompressor()
+    pos = start
+    while pos < len(data):
+        block = data[pos:pos + DECODE_BLOCK_BYTES]
+        try:
+            text = d.decompress(block)
+        except _DECODE_ERRORS:
+            raise ValueError('Corrupt compressed data in the member at byte %d' % start)
+        if d.eof:
+            ends.append(pos + len(block) - len(d.unused_data))
+            yield text
+            return
+        yield text
+        pos += len(block)
+    raise ValueError('Compressed data ends inside the member at byte %d' % start)
+
+
+def _first_member(data, start, end, magic, decompressor):
+    """Where the first member starting in the byte range [start, end) is, or -1 if there is none
+
+    The range may start inside a member, so each occurrence of `magic` is tried, and taken if its first block decodes
+    """
+    pos = start
+    while True:
+        pos = data.find(magic, pos, end + len(magic) - 1)
+        if pos < 0:
+            return -1
+        try:
+            next(_member_blocks(data, pos, decompressor, []))
+            return pos
+        except ValueError:
+            pos += 1
+
+
+def _compressed_chunk_lines(filename, start, end, magic, decompressor):
+    """Generate the lines of a compressed file from the members which start in the byte range [start, end)
+
+    Lines are split between ranges as `_chunk_lines` does, with the line straddling the start of this range's first
+    member belonging to the range before.  Members are decoded a block at a time, so a large one is never held whole
+    """
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        pos = _first_member(data, start, end, magic, decompressor)
+        if pos < 0:
+            return
+        partial = b''
+        # The line straddling the start of the first member was finished by the range before
+        skip = start > 0
+        while pos < len(data):
+            own = pos < end
+            if not own and skip:
+                return
+            ends = []
+            for text in _member_blocks(data, pos, decompressor, ends):
+                text = partial + text
+                partial = b''
+                if skip:
+                    newline = text.find(b'\n')
+                    if newline < 0:
+                        continue
+                    text = text[newline + 1:]
+                    skip = False
+                if not own:
+                    # The range after drops everything up to its first newline, so finish that line here
+                    newline = text.find(b'\n')
+                    if newline >= 0:
+                        for line in text[:newline + 1].decode('utf-8').splitlines(True):
+                            yield line
+                        return
+                    partial = text
+                    continue
+                cut = text.rfind(b'\n') + 1
+                partial = text[cut:]
+                for line in text[:cut].decode('utf-8').splitlines(True):
+                    yield line
+            pos = ends[0]
+        if partial and not skip:
+            for line in partial.decode('utf-8').splitlines(True):
+                yield line
+    finally:
+        data.close()
+
+
+def _chunk_lines(filename, start, end):
+    """Read the lines of a file which start in the byte range [start, end)
+
+    This yields the same lines that iterating the whole file with `codecs.open` would, for that range.  For a
+    compressed file, the range is of compressed bytes, the lines are those of the members starting in it, and they
+    are generated as they are decoded
+    """
+    compression = _compression(filename)
+    if compression is not None:
+        return _compressed_chunk_lines(filename, start, end, *compression[1:])
+    with open(filename, 'rb') as f:
+        if start > 0:
+            # Finish the line straddling start (this reads just the newline if one starts there)
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        if pos >= end:
+            return []
+        data = f.read(end - pos)
+        if not data.endswith(b'\n'):
+            data += f.readline()
+    return data.decode('utf-8').splitlines(True)
+
+
+def _cached_index(filename, kind, build):
+    """Load the example index of a file, made by `build(filename)` and cached next to it as `<filename>.<kind>.idx.npz`
+
+    The cache is rebuilt whenever the size or modification time of the file changes
+    """
+    if _compression(filename) is not None:
+        raise ValueError('%s is compressed, so it cannot be read lazily.  Decompress it first' % filename)
+    cache = '%s.%s.idx.npz' % (filename, kind)
+    stat = os.stat(filename)
+    key = np.array([stat.st_size, stat.st_mtime])
+    if os.path.exists(cache):
+        with np.load(cache) as cached:
+            if np.array_equal(cached['key'], key):
+                return {name: cached[name] for name in cached.files}
+    index = build(filename)
+    index['key'] = key
+    # Write under a temporary name and replace, so a concurrent load never reads a partial index
+    tmp = '%s.%d.tmp.npz' % (cache[:-len('.npz')], os.getpid())
+    try:
+        np.savez(tmp, **index)
+        os.replace(tmp, cache)
+    except (IOError, OSError):
+        # e.g. a read-only directory, which just means indexing again next time
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return index
+
+
+def _text_lines(f):
+    """Iterate the lines of a binary file as `(text, nbytes)`, split where the `codecs` readers would split them
+
+    Those split on every unicode line boundary (as `str.splitlines` does), not only on `\\n`, so an index built
+    from these offsets finds the same lines as reading the file eagerly
+    """
+    for raw in f:
+        text = raw.decode('utf-8')
+        pieces = text.splitlines(True)
+        if len(pieces) == 1:
+            yield text, len(raw)
+        else:
+            for piece in pieces:
+                yield piece, len(piece.encode('utf-8'))
+
+
+def _index_lines(filename):
+    """Index a file with one example per line, labeled by its first field
+
+    :return: The byte offsets of the start and end of every line, and the labels in order of first appearance
+    """
+    starts = array.array('q')
+    labels = []
+    seen = set()
+    pos = 0
+    with open(filename, 'rb') as f:
+        for line, nbytes in _text_lines(f):
+            starts.append(pos)
+            pos += nbytes
+            label = re.split('[\t\s]+', line)[0]
+            if label not in seen:
+                seen.add(label)
+                labels.append(label)
+    starts = np.array(starts, dtype=np.int64)
+    return {'starts': starts, 'ends': np.append(starts[1:], pos), 'labels': np.array(labels, dtype=str)}
+
+
+def _index_blocks(filename):
+    """Index a CONLL file, with one example per sentence, ended by a line without at least two fields
+
+    This finds the same sentences as `CONLLSeqReader.read_lines`, including empty ones
+
+    :return: The byte offsets of the start and end of every sentence, the number of tokens in each, and
+        the labels (the last field of each token) in order of first appearance
+    """
+    starts = array.array('q')
+    ends = array.array('q')
+    lengths = array.array('q')
+    labels = []
+    seen = set()
+    pos = 0
+    start = 0
+    ntoks = 0
+    with open(filename, 'rb') as f:
+        for line, nbytes in _text_lines(f):
+            states = re.split("\s", line.strip())
+            if len(states) > 1:
+                if ntoks == 0:
+                    start = pos
+                ntoks += 1
+                label = states[-1]
+                if label not in seen:
+                    seen.add(label)
+                    labels.append(label)
+            else:
+                starts.append(start if ntoks > 0 else pos)
+                ends.append(pos)
+                lengths.append(ntoks)
+                ntoks = 0
+            pos += nbytes
+    return {'starts': np.array(starts, dtype=np.int64), 'ends': np.array(ends, dtype=np.int64),
+            'lengths': np.array(lengths, dtype=np.int64), 'labels': np.array(labels, dtype=str)}
+
+
+def _parallel_count(count_fn, files, workers, *args):
+    """Run a counting function over byte-range chunks of some files in a process pool
+
+    :param count_fn: A picklable function taking `(filename, start, end) + args`
+    :param files: A list of files, `None` entries are skipped
+    :param workers: The number of processes
+    :return: A generator of `(i, result)` where `i` is the position of the file in `files`, in file and chunk order
+    """
+    positions = []
+    tasks = []
+    for i, file in enumerate(files):
+        if file is None:
+            continue
+        for start, end in _byte_ranges(file, workers):
+            positions.append(i)
+            tasks.append((file, start, end) + args)
+    pool = multiprocessing.Pool(workers)
+    try:
+        for i, result in zip(positions, pool.imap(count_fn, tasks)):
+            yield i, result
+    finally:
+        pool.terminate()
+
+
+def _count_col_chunk(task):
+    filename, start, end, col = task
+    vocab = Counter()
+    for line in _chunk_lines(filename, start, end):
+        cols = re.split("\t", line)
+        text = re.split("\s", cols[col])
+
+        for w in text:
+            w = w.strip()
+            vocab[w] += 1
+    return vocab
+
+
+def _build_vocab_for_col(col, files, workers=1):
     vocab = Counter()
     vocab['<PAD>'] = 1
     vocab['<GO>'] = 1
     vocab['<EOS>'] = 1
 
+    if workers > 1:
+        for _, part in _parallel_count(_count_col_chunk, files, workers, col):
+            vocab.update(part)
+        return vocab
+
     for file in files:
         if file is None:
             continue
-        with codecs.open(file, encoding='utf-8', mode='r') as f:
+        with _open_text(file) as f:
             for line in f:
                 cols = re.split("\t", line)
                 text = re.split("\s", cols[col])
@@ -44,17 +406,48 @@ class ParallelCorpusReader:
         self.max_sentence_length = max_sentence_length
         self.trim = trim
 
-    def build_vocabs(self, files):
+    def build_vocabs(self, files, workers=1):
         pass
 
     def load_examples(self, tsfile, vocab1, vocab2):
         pass
 
-    def load(self, tsfile, vocab1, vocab2, batchsz, shuffle=False):
+    def _index_pairs(self, pairs, vocab1, vocab2):
+        """Index tokenized (source, destination) pairs into ragged `Seq2SeqExamples`
+
+        Only the real tokens of each pair are stored, so memory does not depend on `max_sentence_length`
+        """
+        GO = vocab2['<GO>']
+        EOS = vocab2['<EOS>']
+        mxlen = self.max_sentence_length
+        srcs = array.array('q')
+        tgts = array.array('q')
+        src_offsets = array.array('q', [0])
+        tgt_offsets = array.array('q', [0])
+        for src, dst in pairs:
+            end1 = min(len(src), mxlen)
+            end2 = min(len(dst) + 2, mxlen)-2  # <GO>,...,<EOS>
+            srcs.extend([vocab1[w] for w in src[:end1]])
+
+            tgtl = [GO] + [vocab2[w] for w in dst[:end2]] + [0]
+            tgtl[end2] = EOS
+            tgts.extend(tgtl)
+
+            src_offsets.append(len(srcs))
+            tgt_offsets.append(len(tgts))
+
+        src_dtype = baseline.data.index_dtype(max(vocab1.values()) + 1)
+        tgt_dtype = baseline.data.index_dtype(max(vocab2.values()) + 1)
+        return baseline.data.Seq2SeqExamples(np.frombuffer(srcs, dtype=np.int64).astype(src_dtype),
+                                             np.frombuffer(tgts, dtype=np.int64).astype(tgt_dtype),
+                                             np.frombuffer(src_offsets, dtype=np.int64),
+                                             np.frombuffer(tgt_offsets, dtype=np.int64), mxlen)
+
+    def load(self, tsfile, vocab1, vocab2, batchsz, shuffle=False, **kwargs):
         examples = self.load_examples(tsfile, vocab1, vocab2)
         return baseline.data.Seq2SeqDataFeed(examples, batchsz,
                                              shuffle=shuffle, src_vec_trans=self.src_vec_trans,
-                                             vec_alloc=self.vec_alloc, trim=self.trim)
+                                             trim=self.trim, **kwargs)
 
 class TSVParallelCorpusReader(ParallelCorpusReader):
 
@@ -67,43 +460,19 @@ class TSVParallelCorpusReader(ParallelCorpusReader):
         self.src_col_num = src_col_num
         self.dst_col_num = dst_col_num
 
-    def build_vocabs(self, files):
-        src_vocab = _build_vocab_for_col(self.src_col_num, files)
-        dst_vocab = _build_vocab_for_col(self.dst_col_num, files)
+    def build_vocabs(self, files, workers=1):
+        src_vocab = _build_vocab_for_col(self.src_col_num, files, workers)
+        dst_vocab = _build_vocab_for_col(self.dst_col_num, files, workers)
         return src_vocab, dst_vocab
 
-    def load_examples(self, tsfile, vocab1, vocab2):
-        PAD = vocab1['<PADDING>']
-        GO = vocab2['<GO>']
-        EOS = vocab2['<EOS>']
-        mxlen = self.max_sentence_length
-        ts = []
-        with codecs.open(tsfile, encoding='utf-8', mode='r') as f:
+    def _read_pairs(self, tsfile):
+        with _open_text(tsfile) as f:
             for line in f:
                 splits = re.split("\t", line.strip())
-                src = re.split("\s+", splits[0])
-                dst = re.split("\s+", splits[1])
-
-                srcl = self.vec_alloc(mxlen, dtype=np.int)
-                tgtl = self.vec_alloc(mxlen, dtype=np.int)
-                src_len = len(src)
-                tgt_len = len(dst) + 2  # <GO>,...,<EOS>
-                end1 = min(src_len, mxlen)
-                end2 = min(tgt_len, mxlen)-2
-                tgtl[0] = GO
-                src_len = end1
-                tgt_len = end2+2
-
-                for j in range(end1):
-                    srcl[j] = vocab1[src[j]]
-                for j in range(end2):
-                    tgtl[j + 1] = vocab2[dst[j]]
-
-                tgtl[end2] = EOS
-
-                ts.append((srcl, tgtl, src_len, tgt_len))
+                yield re.split("\s+", splits[0]), re.split("\s+", splits[1])
 
-        return baseline.data.Seq2SeqExamples(ts)
+    def load_examples(self, tsfile, vocab1, vocab2):
+        return self._index_pairs(self._read_pairs(tsfile), vocab1, vocab2)
 
 class MultiFileParallelCorpusReader(ParallelCorpusReader):
 
@@ -120,45 +489,50 @@ class MultiFileParallelCorpusReader(ParallelCorpusReader):
         if not dst_suffix.startswith('.'):
             self.dst_suffix = '.' + self.dst_suffix
 
-    def build_vocabs(self, files):
-        src_vocab = _build_vocab_for_col(0, files)
+    def build_vocabs(self, files, workers=1):
+        src_vocab = _build_vocab_for_col(0, files, workers)
         dst_vocab = src_vocab
         return src_vocab, dst_vocab
 
+    def _read_pairs(self, tsfile):
+        with _open_text(tsfile + self.src_suffix) as fsrc:
+            with _open_text(tsfile + self.dst_suffix) as fdst:
+                for src, dst in zip(fsrc, fdst):
+                    yield re.split("\s+", src.strip()), re.split("\s+", dst.strip())
+
     def load_examples(self, tsfile, vocab1, vocab2):
-        PAD = vocab1['<PADDING>']
-        GO = vocab2['<GO>']
-        EOS = vocab2['<EOS>']
-        mxlen = self.max_sentence_length
-        ts = []
+        return self._index_pairs(self._read_pairs(tsfile), vocab1, vocab2)
 
 
-        with codecs.open(tsfile + self.src_suffix, encoding='utf-8', mode='r') as fsrc:
-            with codecs.open(tsfile + self.dst_suffix, encoding='utf-8', mode='r') as fdst:
-                for src, dst in zip(fsrc, fdst):
+def _vocab_dtype(cache, vocab):
+    """The narrowest type that holds every index in `vocab` (see `baseline.data.index_dtype`)
+
+    This scans the whole vocabulary, so it is kept in `cache` (a dict owned by the reader) for as long as
+    the same, unchanged vocab is passed in, as it is for every (lazy) batch
+    """
+    entry = cache.get(id(vocab))
+    if entry is None or entry[0] is not vocab or entry[1] != len(vocab):
+        entry = (vocab, len(vocab), baseline.data.index_dtype(max(vocab.values()) + 1))
+        cache[id(vocab)] = entry
+    return entry[2]
 
-                    src = re.split("\s+", src.strip())
-                    dst = re.split("\s+", dst.strip())
-                    srcl = self.vec_alloc(mxlen, dtype=np.int)
-                    tgtl = self.vec_alloc(mxlen, dtype=np.int)
-                    src_len = len(src)
-                    tgt_len = len(dst) + 2
-                    end1 = min(src_len, mxlen)
-                    end2 = min(tgt_len, mxlen)-2
-                    last = max(end1, end2)
-                    tgtl[0] = GO
-                    src_len = end1
-                    tgt_len = end2+2
 
-                    for j in range(end1):
-                        srcl[j] = vocab1[src[j]]
-                    for j in range(end2):
-                        tgtl[j + 1] = vocab2[dst[j]]
+def _char_lut(chars_vocab):
+    """Build an array from codepoint to character index, so whole strings can be indexed at once by `_char_ids`
 
-                    tgtl[end2] = EOS
-                    ts.append((srcl, tgtl, src_len, tgt_len))
+    Characters missing from `chars_vocab` map to 0, as does every codepoint past the largest one in it
+    """
+    chars = [(ord(c), i) for c, i in chars_vocab.items() if len(c) == 1]
+    codepoints = np.array([cp for cp, _ in chars], dtype=np.int64)
+    lut = np.zeros(max([cp for cp, _ in chars] + [0]) + 2, dtype=np.int64)
+    lut[codepoints] = np.array([i for _, i in chars], dtype=np.int64)
+    return lut
 
-        return baseline.data.Seq2SeqExamples(ts)
+
+def _char_ids(lut, text):
+    """Map every character in `text` to its index through a table from `_char_lut`"""
+    codepoints = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    return lut[np.minimum(codepoints, len(lut) - 1)]
 
 
 def identity_trans_fn(x):
@@ -186,6 +560,8 @@ class CONLLSeqReader:
         self.vec_shape = vec_shape
         self.trim = trim
         self.label2index = {"<PAD>": 0}
+        self._lut_cache = None
+        self._dtype_cache = {}
 
     @staticmethod
     def web_cleanup(word):
@@ -197,7 +573,78 @@ class CONLLSeqReader:
         if word == '<3': return '&lt;3'
         return word
 
-    def build_vocab(self, files):
+    @staticmethod
+    def _count_chunk(task):
+        filename, start, end, cleanup_fn = task
+        vocab_word = Counter()
+        vocab_ch = Counter()
+        maxw = 0
+        # Sentences can straddle chunks, so keep the lengths of the first and last (partial) ones apart
+        head = None
+        maxs = 0
+        sl = 0
+        for line in _chunk_lines(filename, start, end):
+            line = line.strip()
+            if line == '':
+                if head is None:
+                    head = sl
+                else:
+                    maxs = max(maxs, sl)
+                sl = 0
+
+            else:
+                states = re.split("\s", line)
+                sl += 1
+                w = states[0]
+                vocab_word[cleanup_fn(w)] += 1
+                maxw = max(maxw, len(w))
+                for k in w:
+                    vocab_ch[k] += 1
+        return vocab_word, vocab_ch, maxw, head, maxs, sl
+
+    def _build_vocab_parallel(self, files, workers):
+        vocab_word = Counter()
+        vocab_ch = Counter()
+        maxw = 0
+        maxs = 0
+        last_file = None
+        sl = 0
+        for i, (part_word, part_ch, part_maxw, head, part_maxs, tail) in \
+                _parallel_count(CONLLSeqReader._count_chunk, files, workers, self.cleanup_fn):
+            if i != last_file:
+                sl = 0
+                last_file = i
+            vocab_word.update(part_word)
+            vocab_ch.update(part_ch)
+            maxw = max(maxw, part_maxw)
+            if head is None:
+                sl += tail
+            else:
+                maxs = max(maxs, sl + head, part_maxs)
+                sl = tail
+        return vocab_word, vocab_ch, maxw, maxs
+
+    def build_vocab(self, files, workers=1):
+        """Count words and characters, and find the max word and sentence lengths
+
+        :param files: A list of files, `None` entries are skipped
+        :param workers: If more than 1, count byte-range chunks of the files in this many processes.
+            The results are identical, but `word_trans_fn` must be picklable
+        :return: A `Counter` of characters and a `Counter` of words
+        """
+        if workers > 1:
+            vocab_word, vocab_ch, maxw, maxs = self._build_vocab_parallel(files, workers)
+        else:
+            vocab_word, vocab_ch, maxw, maxs = self._build_vocab_serial(files)
+
+        self.max_word_length = min(maxw, self.max_word_length) if self.max_word_length > 0 else maxw
+        self.max_sentence_length = min(maxs, self.max_sentence_length) if self.max_sentence_length > 0 else maxs
+        print('Max sentence length %d' % self.max_sentence_length)
+        print('Max word length %d' % self.max_word_length)
+
+        return vocab_ch, vocab_word
+
+    def _build_vocab_serial(self, files):
         vocab_word = Counter()
         vocab_ch = Counter()
         maxw = 0
@@ -207,7 +654,7 @@ class CONLLSeqReader:
                 continue
 
             sl = 0
-            with codecs.open(file, encoding='utf-8', mode='r') as f:
+            with _open_text(file) as f:
                 for line in f:
 
                     line = line.strip()
@@ -223,78 +670,128 @@ class CONLLSeqReader:
                         maxw = max(maxw, len(w))
                         for k in w:
                             vocab_ch[k] += 1
-
-        self.max_word_length = min(maxw, self.max_word_length) if self.max_word_length > 0 else maxw
-        self.max_sentence_length = min(maxs, self.max_sentence_length) if self.max_sentence_length > 0 else maxs
-        print('Max sentence length %d' % self.max_sentence_length)
-        print('Max word length %d' % self.max_word_length)
-
-        return vocab_ch, vocab_word
+        return vocab_word, vocab_ch, maxw, maxs
 
     @staticmethod
     def read_lines(tsfile):
+        with _open_text(tsfile) as f:
+            return CONLLSeqReader._read_sentences(f)
+
+    @staticmethod
+    def _read_sentences(lines):
 
         txts = []
         lbls = []
         txt = []
         lbl = []
 
-        with codecs.open(tsfile, encoding='utf-8', mode='r') as f:
-            for line in f:
-                states = re.split("\s", line.strip())
+        for line in lines:
+            states = re.split("\s", line.strip())
 
-                if len(states) > 1:
-                    txt.append(states[0])
-                    lbl.append(states[-1])
-                else:
-                    txts.append(txt)
-                    lbls.append(lbl)
-                    txt = []
-                    lbl = []
+            if len(states) > 1:
+                txt.append(states[0])
+                lbl.append(states[-1])
+            else:
+                txts.append(txt)
+                lbls.append(lbl)
+                txt = []
+                lbl = []
 
 
         return txts, lbls
 
-    def load(self, filename, words_vocab, chars_vocab, batchsz, shuffle=False):
+    def load_examples(self, filename, words_vocab, chars_vocab):
+        """Index a file into `SeqWordCharTagExamples`
+
+        The words, tags and characters of every sentence are appended to flat arrays, so memory
+        scales with the real number of tokens and characters, not with the max lengths.
 
-        ts = []
+        :return: The examples and the list of raw sentences
+        """
+        txts, lbls = CONLLSeqReader.read_lines(filename)
+        return self._index_sentences(txts, lbls, words_vocab, chars_vocab, np.arange(len(txts))), txts
+
+    def _char_table(self, chars_vocab):
+        """The `_char_lut` of `chars_vocab`, kept so that every (lazy) batch indexed with the same vocab shares it"""
+        if self._lut_cache is None or self._lut_cache[0] is not chars_vocab or self._lut_cache[1] != len(chars_vocab):
+            self._lut_cache = (chars_vocab, len(chars_vocab), _char_lut(chars_vocab))
+        return self._lut_cache[2]
+
+    def _index_sentences(self, txts, lbls, words_vocab, chars_vocab, ids, do_shuffle=True, do_sort=True):
+        words = array.array('q')
+        tags = array.array('q')
+        spelled = []
+        offsets = array.array('q', [0])
         idx = 0
         mxlen = self.max_sentence_length
         maxw = self.max_word_length
-        txts, lbls = CONLLSeqReader.read_lines(filename)
 
         for i in range(len(txts)):
 
-            xs_ch = self.vec_alloc((mxlen, maxw), dtype=np.int)
-            xs = self.vec_alloc((mxlen), dtype=np.int)
-            ys = self.vec_alloc((mxlen), dtype=np.int)
-
             lv = lbls[i]
             v = txts[i]
 
-            length = mxlen
-            for j in range(mxlen):
-
-                if j == len(v):
-                    length = j
-                    break
+            for j in range(min(len(v), mxlen)):
 
                 w = v[j]
-                nch = min(len(w), maxw)
                 label = lv[j]
 
                 if label not in self.label2index:
                     idx += 1
                     self.label2index[label] = idx
 
-                ys[j] = self.label2index[label]
-                xs[j] = words_vocab.get(self.cleanup_fn(w))
-                for k in range(nch):
-                    xs_ch[j, k] = chars_vocab.get(w[k], 0)
-
-            ts.append((xs, xs_ch, ys, length, i))
-        examples = baseline.data.SeqWordCharTagExamples(ts)
-        return baseline.data.SeqWordCharLabelDataFeed(examples, batchsz=batchsz, shuffle=shuffle, vec_alloc=self.vec_alloc, vec_shape=self.vec_shape), txts
+                tags.append(self.label2index[label])
+                words.append(words_vocab.get(self.cleanup_fn(w)))
+                spelled.append(w[:maxw])
+
+            offsets.append(len(words))
+
+        # Index the characters of every token in one go, rather than looking each one up in turn
+        chars = _char_ids(self._char_table(chars_vocab), ''.join(spelled))
+        char_offsets = np.zeros(len(spelled) + 1, dtype=np.int64)
+        np.cumsum([len(w) for w in spelled], out=char_offsets[1:])
+
+        word_dtype = _vocab_dtype(self._dtype_cache, words_vocab)
+        char_dtype = _vocab_dtype(self._dtype_cache, chars_vocab)
+        tag_dtype = baseline.data.index_dtype(len(self.label2index) + 1)
+        examples = baseline.data.SeqWordCharTagExamples(np.frombuffer(words, dtype=np.int64).astype(word_dtype),
+                                                         chars.astype(char_dtype),
+                                                         np.frombuffer(tags, dtype=np.int64).astype(tag_dtype),
+                                                         np.frombuffer(offsets, dtype=np.int64),
+                                                         char_offsets,
+                                                         ids, mxlen, maxw, do_shuffle, do_sort)
+        return examples
+
+    def load(self, filename, words_vocab, chars_vocab, batchsz, shuffle=False, **kwargs):
+        examples, txts = self.load_examples(filename, words_vocab, chars_vocab)
+        return baseline.data.SeqWordCharLabelDataFeed(examples, batchsz=batchsz, shuffle=shuffle, trim=self.trim,
+                                                      **kwargs), txts
+
+    def _parse_sentences(self, words_vocab, chars_vocab, texts, ids):
+        lines = []
+        for text in texts:
+            lines += text.splitlines() + ['']
+        txts, lbls = CONLLSeqReader._read_sentences(lines)
+        return self._index_sentences(txts, lbls, words_vocab, chars_vocab, ids, do_shuffle=False, do_sort=False)
+
+    def load_lazy(self, filename, words_vocab, chars_vocab, batchsz, shuffle=False, **kwargs):
+        """Like `load()`, but each sentence is only read from the file when a batch needs it
+
+        Only the byte offsets of the sentences (and the tag set) are read up front, and cached next to the file,
+        so a second load of the same file returns almost at once.  The raw sentences are not returned
+
+        :return: A `SeqWordCharLabelDataFeed` over `baseline.data.LazyExamples`
+        """
+        index = _cached_index(filename, 'conll', _index_blocks)
+        for label in index['labels'].tolist():
+            if label not in self.label2index:
+                self.label2index[label] = len(self.label2index)
+        examples = baseline.data.LazyExamples(filename, index['starts'], index['ends'],
+                                              np.minimum(index['lengths'], self.max_sentence_length),
+                                              functools.partial(self._parse_sentences, words_vocab, chars_vocab),
+                                              do_sort=True)
+        return baseline.data.SeqWordCharLabelDataFeed(examples, batchsz=batchsz, shuffle=shuffle, trim=self.trim,
+                                                      **kwargs)
 
 
 class TSVSeqLabelReader:
@@ -308,8 +805,16 @@ class TSVSeqLabelReader:
                 ",": " , ",
                 "!": " ! ",
                 }
-
-    def __init__(self, mxlen=1000, mxfiltsz=0, clean_fn=None, vec_alloc=np.zeros, src_vec_trans=None):
+    # Every REPLACE key in one pass.  No key overlaps another or appears in a replacement, so this is the
+    # same as applying them one after the other
+    REPLACE_RE = re.compile('|'.join(re.escape(k) for k in sorted(REPLACE, key=len, reverse=True)))
+    UNCLEAN_RE = re.compile(r"[^A-Za-z0-9(),!?\'\`]")
+
+    def __init__(self, mxlen=1000, mxfiltsz=0, clean_fn=None, vec_alloc=np.zeros, src_vec_trans=None, memoize=False):
+        """
+        :param memoize: Remember the label and tokens of every distinct line, so repeated lines (across files,
+            or on a second pass) are only tokenized once.  This holds every distinct line in memory
+        """
         self.vocab = None
         self.label2index = {}
         self.clean_fn = clean_fn #TSVSeqLabelReader.do_clean
@@ -317,19 +822,51 @@ class TSVSeqLabelReader:
         self.mxfiltsz = mxfiltsz
         self.vec_alloc=vec_alloc
         if self.clean_fn is None:
-            self.clean_fn = lambda x: x
+            self.clean_fn = identity_trans_fn
         self.src_vec_trans = src_vec_trans
+        self.token_streams = {}
+        self.memo = {} if memoize else None
+        self._dtype_cache = {}
+
     @staticmethod
     def splits(text):
         return list(filter(lambda s: len(s) != 0, re.split('\s+', text)))
 
+    @staticmethod
+    def _replace(match):
+        return TSVSeqLabelReader.REPLACE[match.group(0)]
+
     @staticmethod
     def do_clean(l):
-        l = l.lower()
-        l = re.sub(r"[^A-Za-z0-9(),!?\'\`]", " ", l)
-        for k, v in TSVSeqLabelReader.REPLACE.items():
-            l = l.replace(k, v)
-        return l.strip()
+        l = TSVSeqLabelReader.UNCLEAN_RE.sub(" ", l.lower())
+        return TSVSeqLabelReader.REPLACE_RE.sub(TSVSeqLabelReader._replace, l).strip()
+
+    @staticmethod
+    def tokenize(line, clean_fn):
+        """The label and tokens of a line, exactly `splits()` of the text from `label_and_sentence()`, in one pass
+
+        `do_clean` works a character at a time and none of its replacements cross whitespace, so it is run once
+        over the whole line rather than once per word.  Any other `clean_fn` is still run per word
+        """
+        words = line.split()
+        if not words or line[:1].isspace():
+            label = ''
+        else:
+            label = words[0]
+            words = words[1:]
+        if clean_fn is identity_trans_fn:
+            return label, words
+        if clean_fn is TSVSeqLabelReader.do_clean:
+            return label, TSVSeqLabelReader.do_clean(' '.join(words)).split()
+        return label, [tok for w in words for tok in clean_fn(w).split()]
+
+    def _line_tokens(self, line):
+        if self.memo is None:
+            return TSVSeqLabelReader.tokenize(line, self.clean_fn)
+        tokens = self.memo.get(line)
+        if tokens is None:
+            tokens = self.memo[line] = TSVSeqLabelReader.tokenize(line, self.clean_fn)
+        return tokens
 
     @staticmethod
     def label_and_sentence(line, clean_fn):
@@ -339,91 +876,301 @@ class TSVSeqLabelReader:
         text = ' '.join(list(filter(lambda s: len(s) != 0, [clean_fn(w) for w in text])))
         return label, text
 
-    def build_vocab(self, files):
+    def _tokenize(self, filename, word2id, label2id):
+        """Read and tokenize a file once, interning its words and labels into compact id arrays
+
+        :return: A tuple of the label ids, the number of tokens per line and the concatenated token ids
+        """
+        labels = array.array('i')
+        lengths = array.array('i')
+        ids = array.array('i')
+        with _open_text(filename) as f:
+            for line in f:
+                label, toks = self._line_tokens(line)
+                labels.append(label2id.setdefault(label, len(label2id)))
+                lengths.append(len(toks))
+                ids.extend([word2id.setdefault(w, len(word2id)) for w in toks])
+
+        return np.frombuffer(labels, dtype=np.int32), np.frombuffer(lengths, dtype=np.int32), \
+            np.frombuffer(ids, dtype=np.int32)
+
+    @staticmethod
+    def _count_chunk(task):
+        filename, start, end, clean_fn = task
+        vocab = Counter()
+        for line in _chunk_lines(filename, start, end):
+            vocab.update(TSVSeqLabelReader.tokenize(line, clean_fn)[1])
+        return vocab
+
+    def build_vocab(self, files, keep_tokens=False, workers=1):
+        """Count the words in some files
+
+        :param files: A list of files, `None` entries are skipped
+        :param keep_tokens: If `True`, tokenize each file only once and keep its token stream as interned ids,
+            so that a later `load()` of the same file is indexed from memory without re-reading or re-tokenizing
+        :param workers: If more than 1 (and not `keep_tokens`), count byte-range chunks of the files in this
+            many processes.  The results are identical, but `clean_fn` must be picklable
+        :return: A `Counter` of words
+        """
+        if keep_tokens:
+            return self._build_vocab_and_tokenize(files)
+
+        if workers > 1:
+            vocab = Counter()
+            for _, part in _parallel_count(TSVSeqLabelReader._count_chunk, files, workers, self.clean_fn):
+                vocab.update(part)
+            return vocab
+
         vocab = Counter()
         for file in files:
             if file is None:
                 continue
-            with codecs.open(file, encoding='utf-8', mode='r') as f:
+            with _open_text(file) as f:
                 for line in f:
-                    _, text = TSVSeqLabelReader.label_and_sentence(line, self.clean_fn)
-                    for w in TSVSeqLabelReader.splits(text):
-                        vocab[w] += 1
+                    vocab.update(self._line_tokens(line)[1])
         return vocab
 
-    def load(self, filename, index, batchsz, shuffle=False):
-
-        PAD = index['<PADDING>']
+    def _build_vocab_and_tokenize(self, files):
+        word2id = {}
+        label2id = {}
+        self.token_streams = {}
+        counts = np.zeros(0, dtype=np.int64)
+        for file in files:
+            if file is None:
+                continue
+            stream = self._tokenize(file, word2id, label2id)
+            self.token_streams[file] = stream
+            counts = np.concatenate([counts, np.zeros(len(word2id) - len(counts), dtype=np.int64)])
+            counts += np.bincount(stream[2], minlength=len(word2id))
+
+        # Interned ids are in order of first appearance, so this has the same order as the serial Counter
+        self.words = list(word2id.keys())
+        self.labels = list(label2id.keys())
+        return Counter(dict(zip(self.words, counts.tolist())))
+
+    def _stack(self, lengths, keys, index):
+        """Lay the token ids of every line out in one `(N, mxlen)` array, leaving room for the zero padding
+
+        :param lengths: The number of tokens on each line
+        :param keys: The indices of all tokens, concatenated
+        :param index: The word to index map, which decides the narrowest type the ids fit in
+        :return: The stacked ids, and how much of each row is used
+        """
         halffiltsz = self.mxfiltsz // 2
         nozplen = self.mxlen - 2*halffiltsz
-        label_idx = len(self.label2index)
-        examples = []
-        with codecs.open(filename, encoding='utf-8', mode='r') as f:
-            for offset, line in enumerate(f):
-                label, text = TSVSeqLabelReader.label_and_sentence(line, self.clean_fn)
-                if label not in self.label2index:
-                    self.label2index[label] = label_idx
-                    label_idx += 1
-
-                y = self.label2index[label]
-                toks = TSVSeqLabelReader.splits(text)
-                mx = min(len(toks), nozplen)
-                toks = toks[:mx]
-                x = self.vec_alloc(self.mxlen, dtype=int)
-                for j in range(len(toks)):
-                    w = toks[j]
-                    key = index.get(w, PAD)
-                    x[j+halffiltsz] = key
-                examples.append((x, y))
-        return baseline.data.SeqLabelDataFeed(baseline.data.SeqLabelExamples(examples),
-                                              batchsz=batchsz, shuffle=shuffle, vec_alloc=self.vec_alloc, src_vec_trans=self.src_vec_trans)
+        mx = np.minimum(lengths, nozplen)
+        x = np.zeros((len(lengths), self.mxlen), dtype=_vocab_dtype(self._dtype_cache, index))
+        rows, cols, src = baseline.data.ragged_index(np.cumsum(lengths) - lengths, mx)
+        x[rows, cols + halffiltsz] = keys[src]
+        return x, np.maximum(mx, 1) + 2*halffiltsz
+
+    def _load_token_stream(self, filename, index):
+        label_ids, lengths, ids = self.token_streams.pop(filename)
+        PAD = index['<PADDING>']
+        # Map each interned word and label once, then index the whole stream with them
+        keys = np.array([index.get(w, PAD) for w in self.words], dtype=np.int64)[ids]
+        label_map = np.zeros(len(self.labels), dtype=np.int64)
+        # Labels new to label2index are numbered in order of first appearance in this file, as _load_file does
+        seen, first = np.unique(label_ids, return_index=True)
+        for label_id in seen[np.argsort(first)].tolist():
+            label = self.labels[label_id]
+            label_map[label_id] = self.label2index.setdefault(label, len(self.label2index))
+        x, widths = self._stack(lengths.astype(np.int64), keys, index)
+        y = label_map[label_ids].astype(baseline.data.index_dtype(len(self.label2index)))
+        return x, y, widths
+
+    def load_examples(self, filename, index):
+        """Index a file into a stacked array of word ids and an array of labels
+
+        :return: The word ids, the labels, and how much of each `x` is used (the tokens plus the zero padding
+            on both sides)
+        """
+        if filename in self.token_streams:
+            return self._load_token_stream(filename, index)
+        return self._load_file(filename, index)
+
+    def load(self, filename, index, batchsz, shuffle=False, **kwargs):
+        x, y, lengths = self.load_examples(filename, index)
+        return baseline.data.SeqLabelDataFeed(baseline.data.SeqLabelExamples(x, y, lengths),
+                                              batchsz=batchsz, shuffle=shuffle, src_vec_trans=self.src_vec_trans,
+                                              **kwargs)
+
+    def _parse_lines(self, index, texts, ids):
+        x, y, widths = self._load_lines(texts, index)
+        return baseline.data.SeqLabelExamples(x, y, widths, do_shuffle=False)
+
+    def load_lazy(self, filename, index, batchsz, shuffle=False, **kwargs):
+        """Like `load()`, but each line is only read from the file when a batch needs it
+
+        Only the byte offsets of the lines (and the labels) are read up front, and cached next to the file,
+        so a second load of the same file returns almost at once.  Without reading them, the lengths of the
+        lines are unknown, so `buckets` and `max_tokens` see every example as `mxlen` long
+
+        :return: A `SeqLabelDataFeed` over `baseline.data.LazyExamples`
+        """
+        lines = _cached_index(filename, 'tsv', _index_lines)
+        for label in lines['labels'].tolist():
+            self.label2index.setdefault(label, len(self.label2index))
+        examples = baseline.data.LazyExamples(filename, lines['starts'], lines['ends'],
+                                              np.full(len(lines['starts']), self.mxlen, dtype=np.int64),
+                                              functools.partial(self._parse_lines, index))
+        return baseline.data.SeqLabelDataFeed(examples, batchsz=batchsz, shuffle=shuffle,
+                                              src_vec_trans=self.src_vec_trans, **kwargs)
+
+    def _load_file(self, filename, index):
+        with _open_text(filename) as f:
+            return self._load_lines(f, index)
+
+    def _load_lines(self, lines, index):
+        PAD = index['<PADDING>']
+        nozplen = self.mxlen - 2*(self.mxfiltsz // 2)
+        ys = array.array('i')
+        lengths = array.array('i')
+        keys = array.array('i')
+        for line in lines:
+            label, toks = self._line_tokens(line)
+            ys.append(self.label2index.setdefault(label, len(self.label2index)))
+            toks = toks[:nozplen]
+            lengths.append(len(toks))
+            keys.extend([index.get(w, PAD) for w in toks])
+        x, widths = self._stack(np.array(lengths, dtype=np.int64), np.array(keys, dtype=np.int64), index)
+        return x, np.array(ys, dtype=baseline.data.index_dtype(len(self.label2index))), widths
 
 class PTBSeqReader:
 
     def __init__(self, max_word_length, nbptt):
         self.max_word_length = max_word_length
         self.nbptt = nbptt
+        self._dtype_cache = {}
 
-    def build_vocab(self, files):
+    @staticmethod
+    def _count_lines(lines):
         vocab_word = Counter()
         vocab_ch = Counter()
         maxw = 0
-        num_words_in_files = []
-        for file in files:
-            if file is None:
-                continue
+        num_words = 0
+        for line in lines:
+            sentence = line.split() + ['<EOS>']
+            num_words += len(sentence)
+            for w in sentence:
+                vocab_word[w] += 1
+                maxw = max(maxw, len(w))
+                for k in w:
+                    vocab_ch[k] += 1
+        return vocab_word, vocab_ch, maxw, num_words
 
-            with codecs.open(file, encoding='utf-8', mode='r') as f:
-                num_words = 0
-                for line in f:
-                    sentence = line.split() + ['<EOS>']
-                    num_words += len(sentence)
-                    for w in sentence:
-                        vocab_word[w] += 1
-                        maxw = max(maxw, len(w))
-                        for k in w:
-                            vocab_ch[k] += 1
-                num_words_in_files.append(num_words)
+    @staticmethod
+    def _count_chunk(task):
+        filename, start, end = task
+        return PTBSeqReader._count_lines(_chunk_lines(filename, start, end))
+
+    def build_vocab(self, files, workers=1):
+        """Count words and characters, the max word length and the number of words in each file
+
+        :param files: A list of files, `None` entries are skipped
+        :param workers: If more than 1, count byte-range chunks of the files in this many processes
+        :return: A `Counter` of characters, a `Counter` of words and a list of word counts, one per file
+        """
+        vocab_word = Counter()
+        vocab_ch = Counter()
+        maxw = 0
+        num_words_in_files = {i: 0 for i, file in enumerate(files) if file is not None}
+        if workers > 1:
+            parts = _parallel_count(PTBSeqReader._count_chunk, files, workers)
+        else:
+            parts = ((i, PTBSeqReader._count_lines(_file_lines(file)))
+                     for i, file in enumerate(files) if file is not None)
+
+        for i, (part_word, part_ch, part_maxw, num_words) in parts:
+            vocab_word.update(part_word)
+            vocab_ch.update(part_ch)
+            maxw = max(maxw, part_maxw)
+            num_words_in_files[i] += num_words
+        num_words_in_files = [num_words_in_files[i] for i in sorted(num_words_in_files.keys())]
 
         self.max_word_length = min(maxw, self.max_word_length)
         print('Max word length %d' % self.max_word_length)
 
         return vocab_ch, vocab_word, num_words_in_files
 
-    def load(self, filename, words_vocab, chars_vocab, num_words, batchsz, vec_alloc=np.zeros):
-
-        xch = vec_alloc((num_words, self.max_word_length), np.int)
-        x = vec_alloc((num_words), np.int)
+    def word_chars(self, words_vocab, chars_vocab):
+        """Spell out every word in the vocabulary as a row of character ids
+
+        :param words_vocab: The word to index map
+        :param chars_vocab: The character to index map
+        :return: An array of shape `(max word index + 1, max_word_length)`, where row `i` holds the
+            (truncated, zero-padded) characters of the word with index `i`
+        """
+        word_chars = np.zeros((max(words_vocab.values()) + 1, self.max_word_length),
+                              dtype=baseline.data.index_dtype(max(chars_vocab.values()) + 1))
+        rows = np.array(list(words_vocab.values()), dtype=np.int64)
+        spelled = [w[:self.max_word_length] for w in words_vocab.keys()]
+        lengths = np.array([len(w) for w in spelled], dtype=np.int64)
+        which, cols, flat = baseline.data.ragged_index(np.cumsum(lengths) - lengths, lengths)
+        word_chars[rows[which], cols] = _char_ids(_char_lut(chars_vocab), ''.join(spelled))[flat]
+        return word_chars
+
+    def load_examples(self, filename, words_vocab, chars_vocab, num_words, vec_alloc=np.zeros):
+        """Index a file of sentences as one stream of words
+
+        Characters are not stored per running word.  Instead, `xch` for a word id `x[i]` is `word_chars[x[i]]`
+
+        :return: The word ids, and the `word_chars` table
+        """
+        x = vec_alloc((num_words), _vocab_dtype(self._dtype_cache, words_vocab))
         i = 0
-        with codecs.open(filename, encoding='utf-8', mode='r') as f:
+        with _open_text(filename) as f:
             for line in f:
                 sentence = line.split() + ['<EOS>']
-                num_words += len(sentence)
                 for w in sentence:
                     x[i] = words_vocab.get(w)
-                    nch = min(len(w), self.max_word_length)
-                    for k in range(nch):
-                        xch[i, k] = chars_vocab.get(w[k], 0)
                     i += 1
 
-        return baseline.data.SeqWordCharDataFeed(x, xch, self.nbptt, batchsz, self.max_word_length)
+        return x, self.word_chars(words_vocab, chars_vocab)
+
+    def load(self, filename, words_vocab, chars_vocab, num_words, batchsz, vec_alloc=np.zeros):
+        x, word_chars = self.load_examples(filename, words_vocab, chars_vocab, num_words, vec_alloc)
+        return baseline.data.SeqWordCharDataFeed(x, word_chars, self.nbptt, batchsz, self.max_word_length)
+
+    @staticmethod
+    def write_stream(filename, words_vocab, outfile, bufsz=1024*1024, workers=1):
+        """Index a file of sentences straight to disk, as a flat stream of word ids
+
+        The ids are written in the narrowest type that holds the vocabulary (see `baseline.data.index_dtype`).
+        Only `bufsz` ids are held in memory at a time, and the number of words need not be known up front
+
+        :param filename: The file of sentences
+        :param words_vocab: The word to index map
+        :param outfile: The file to write the ids to
+        :param bufsz: How many ids to buffer between writes
+        :param workers: If the file is compressed, decode it in this many processes
+        :return: The number of ids written
+        """
+        num_words = 0
+        typecode = np.dtype(baseline.data.index_dtype(max(words_vocab.values()) + 1)).char
+        buf = array.array(typecode)
+        with open(outfile, 'wb') as f:
+            for line in _file_lines(filename, workers):
+                buf.extend(words_vocab.get(w) for w in line.split() + ['<EOS>'])
+                if len(buf) >= bufsz:
+                    buf.tofile(f)
+                    num_words += len(buf)
+                    buf = array.array(typecode)
+            buf.tofile(f)
+            num_words += len(buf)
+        return num_words
+
+    def load_stream(self, filename, words_vocab, chars_vocab, batchsz, outfile=None, workers=1):
+        """Like `load()`, but the word ids are written to disk by `write_stream()` and memory-mapped
+
+        Each batch is then a strided view of the file, so the corpus never has to fit in memory
+
+        :param outfile: Where to write the ids, defaults to `filename` + `.ids`
+        :param workers: If the file is compressed, decode it in this many processes
+        :return: A `SeqWordCharDataFeed`
+        """
+        outfile = filename + '.ids' if outfile is None else outfile
+        self.write_stream(filename, words_vocab, outfile, workers=workers)
+        x = np.memmap(outfile, dtype=_vocab_dtype(self._dtype_cache, words_vocab), mode='r')
+        return baseline.data.SeqWordCharDataFeed(x, self.word_chars(words_vocab, chars_vocab), self.nbptt, batchsz,
+                                                 self.max_word_length)
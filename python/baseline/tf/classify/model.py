@@ -6,6 +6,7 @@ import json
 from tensorflow.contrib.layers import convolution2d, fully_connected, flatten, xavier_initializer
 from baseline.utils import fill_y
 from baseline.model import Classifier
+from baseline.tf.tfy import embedding_variable
 
 
 class ConvModel(Classifier):
@@ -105,7 +106,7 @@ class ConvModel(Classifier):
 
         # Use pre-trained embeddings from word2vec
         with tf.name_scope("LUT"):
-            W = tf.Variable(tf.constant(w2v.weights, dtype=tf.float32), name="W", trainable=finetune)
+            W = embedding_variable(w2v, "W", trainable=finetune)
             e0 = tf.scatter_update(W, tf.constant(0, dtype=tf.int32, shape=[1]), tf.zeros(shape=[1, dsz]))
             with tf.control_dependencies([e0]):
                 # Zeropad out the word ids in the sentence to half the max
@@ -3,7 +3,7 @@ from baseline.confusion import ConfusionMatrix
 from baseline.progress import ProgressBar
 from baseline.reporting import basic_reporting
 from baseline.utils import listify
-from baseline.tf.tfy import optimizer
+from baseline.tf.tfy import optimizer, embedding_init_feed
 from baseline.train import EpochReportingTrainer
 
 
@@ -20,23 +20,27 @@ class ClassifyTrainerTf(EpochReportingTrainer):
 
         cm = ConfusionMatrix(self.model.labels)
         total_loss = 0
+        total = 0
         steps = len(loader)
         pg = ProgressBar(steps)
         for x, y in loader:
             feed_dict = self.model.ex2dict(x, y, do_dropout=True)
             _, step, lossv, guess = self.sess.run([self.train_op, self.global_step, self.loss, self.model.best], feed_dict=feed_dict)
             cm.add_batch(y, guess)
-            total_loss += lossv
+            # Batches may differ in size, so weight each batch's mean loss by its size
+            total_loss += lossv * len(y)
+            total += len(y)
             pg.update()
 
         pg.done()
         metrics = cm.get_all_metrics()
-        metrics['avg_loss'] = total_loss/float(steps)
+        metrics['avg_loss'] = total_loss/float(total)
         return metrics
 
     def _test(self, loader):
 
         total_loss = 0
+        total = 0
         cm = ConfusionMatrix(self.model.labels)
         steps = len(loader)
         pg = ProgressBar(steps)
@@ -44,12 +48,13 @@ class ClassifyTrainerTf(EpochReportingTrainer):
             feed_dict = self.model.ex2dict(x, y)
             lossv, guess = self.sess.run([self.loss, self.model.best], feed_dict=feed_dict)
             cm.add_batch(y, guess)
-            total_loss += lossv
+            total_loss += lossv * len(y)
+            total += len(y)
             pg.update()
 
         pg.done()
         metrics = cm.get_all_metrics()
-        metrics['avg_loss'] = total_loss/float(steps)
+        metrics['avg_loss'] = total_loss/float(total)
 
         return metrics
 
@@ -99,7 +104,7 @@ def fit(model, ts, vs, es=None, **kwargs):
     print('reporting', reporting_fns)
     
     trainer = ClassifyTrainerTf(model, **kwargs)
-    model.sess.run(tf.global_variables_initializer())
+    model.sess.run(tf.global_variables_initializer(), feed_dict=embedding_init_feed(model.sess.graph))
     model.saver = tf.train.Saver()
 
     max_metric = 0
@@ -72,7 +72,7 @@ class WordLanguageModel(AbstractLanguageModel):
         vsz = word_vec.vsz + 1
 
         with tf.name_scope("WordLUT"):
-            Ww = tf.Variable(tf.constant(word_vec.weights, dtype=tf.float32), name="W")
+            Ww = embedding_variable(word_vec, "W")
             we0 = tf.scatter_update(Ww, tf.constant(0, dtype=tf.int32, shape=[1]), tf.zeros(shape=[1, word_vec.dsz]))
             with tf.control_dependencies([we0]):
                 wembed = tf.nn.embedding_lookup(Ww, self.x, name="embeddings")
@@ -121,7 +121,7 @@ class CharCompLanguageModel(AbstractLanguageModel):
         self.maxw = maxw
         self.pdrop_value = pdrop
         char_dsz = char_vec.dsz
-        Wc = tf.Variable(tf.constant(char_vec.weights, dtype=tf.float32), name="Wch")
+        Wc = embedding_variable(char_vec, "Wch")
         ce0 = tf.scatter_update(Wc, tf.constant(0, dtype=tf.int32, shape=[1]), tf.zeros(shape=[1, char_dsz]))
 
         with tf.control_dependencies([ce0]):
@@ -111,7 +111,7 @@ def fit(model, ts, vs, es=None, **kwargs):
     after_train_fn = kwargs['after_train_fn'] if 'after_train_fn' in kwargs else None
     trainer = LanguageModelTrainerTf(model, **kwargs)
     init = tf.global_variables_initializer()
-    model.sess.run(init)
+    model.sess.run(init, feed_dict=embedding_init_feed(model.sess.graph))
     saver = tf.train.Saver()
     model.save_using(saver)
 
@@ -91,8 +91,8 @@ class Seq2SeqModel(EncoderDecoder):
         model.dsz = src_vocab.dsz
 
         with tf.name_scope("LUT"):
-            Wi = tf.Variable(tf.constant(src_vocab.weights, dtype=tf.float32), name="Wi")
-            Wo = tf.Variable(tf.constant(dst_vocab.weights, dtype=tf.float32), name="Wo")
+            Wi = embedding_variable(src_vocab, "Wi")
+            Wo = embedding_variable(dst_vocab, "Wo")
 
             embed_in = tf.nn.embedding_lookup(Wi, model.src)
             
@@ -2,7 +2,7 @@ import tensorflow as tf
 import numpy as np
 from baseline.utils import listify
 from baseline.reporting import basic_reporting
-from baseline.tf.tfy import optimizer
+from baseline.tf.tfy import optimizer, embedding_init_feed
 from baseline.train import Trainer
 
 
@@ -28,6 +28,7 @@ class Seq2SeqTrainerTf(Trainer):
 
     def train(self, ts, reporting_fns):
         total_loss = 0
+        total = 0
         steps = 0
         metrics = {}
 
@@ -36,17 +37,19 @@ class Seq2SeqTrainerTf(Trainer):
             steps += 1
             feed_dict = self.model.make_feed_dict(src, src_len, tgt, tgt_len)
             _, global_step, lossv = self.model.sess.run([self.train_op, self.global_step, self.loss], feed_dict=feed_dict)
-            total_loss += lossv
+            # Batches may differ in size, so weight each batch's loss by its size
+            total_loss += lossv * len(src_len)
+            total += len(src_len)
             if steps % 500 == 0:
-                metrics['avg_loss'] = total_loss / steps
-                metrics['perplexity'] = np.exp(total_loss / steps)
+                metrics['avg_loss'] = total_loss / total
+                metrics['perplexity'] = np.exp(total_loss / total)
                 for reporting in reporting_fns:
                     reporting(metrics, global_step, 'Train')
             
         assert(steps == len(ts))
 
-        metrics['avg_loss'] = total_loss / steps
-        metrics['perplexity'] = np.exp(total_loss / steps)
+        metrics['avg_loss'] = total_loss / total
+        metrics['perplexity'] = np.exp(total_loss / total)
         for reporting in reporting_fns:
             reporting(metrics, global_step, 'Train')
         return metrics
@@ -58,14 +61,15 @@ class Seq2SeqTrainerTf(Trainer):
             epochs = self.valid_epochs
 
         total_loss = 0
-        steps = len(vs)
+        total = 0
         metrics = {}
         for src,tgt,src_len,tgt_len in vs:
             feed_dict = self.model.make_feed_dict(src, src_len, tgt, tgt_len)
             lossv = self.model.sess.run(self.loss, feed_dict=feed_dict)
-            total_loss += lossv
+            total_loss += lossv * len(src_len)
+            total += len(src_len)
 
-        avg_loss = total_loss/steps
+        avg_loss = total_loss/total
         metrics['avg_loss'] = avg_loss
         metrics['perplexity'] = np.exp(avg_loss)
         for reporting in reporting_fns:
@@ -81,7 +85,7 @@ def fit(seq2seq, ts, vs, es=None, **kwargs):
     after_train_fn = kwargs['after_train_fn'] if 'after_train_fn' in kwargs else None
     trainer = Seq2SeqTrainerTf(seq2seq, **kwargs)
     init = tf.global_variables_initializer()
-    seq2seq.sess.run(init)
+    seq2seq.sess.run(init, feed_dict=embedding_init_feed(seq2seq.sess.graph))
     saver = tf.train.Saver()
     trainer.prepare(saver)
 
@@ -3,7 +3,7 @@ import numpy as np
 from baseline.utils import to_spans, f_score, listify, revlut
 from baseline.progress import ProgressBar
 from baseline.reporting import basic_reporting
-from baseline.tf.tfy import optimizer
+from baseline.tf.tfy import optimizer, embedding_init_feed
 from baseline.train import EpochReportingTrainer
 
 
@@ -118,16 +118,19 @@ class TaggerTrainerTf(EpochReportingTrainer):
 
     def _train(self, ts):
         total_loss = 0
+        total = 0
         steps = len(ts)
         metrics = {}
         pg = ProgressBar(steps)
         for x, xch, y, lengths, id in ts:
             feed_dict = self.model.make_feed_dict(x, xch, y, do_dropout=True)
             _, step, lossv = self.model.sess.run([self.train_op, self.global_step, self.loss], feed_dict=feed_dict)
-            total_loss += lossv
+            # Batches may differ in size, so weight each batch's loss by its size
+            total_loss += lossv * len(lengths)
+            total += len(lengths)
             pg.update()
         pg.done()
-        metrics['avg_loss'] = float(total_loss)/steps
+        metrics['avg_loss'] = float(total_loss)/total
         return metrics
 
     def _test(self, ts, conll_file=None, txts=None):
@@ -142,7 +145,7 @@ def fit(model, ts, vs, es, **kwargs):
     after_train_fn = kwargs['after_train_fn'] if 'after_train_fn' in kwargs else None
     trainer = TaggerTrainerTf(model, **kwargs)
     init = tf.global_variables_initializer()
-    model.sess.run(init)
+    model.sess.run(init, feed_dict=embedding_init_feed(model.sess.graph))
     saver = tf.train.Saver()
     model.save_using(saver)
     do_early_stopping = bool(kwargs.get('do_early_stopping', True))
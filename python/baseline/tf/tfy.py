@@ -1,6 +1,7 @@
 import tensorflow as tf
 import numpy as np
 import math
+import weakref
 
 from tensorflow.python.layers import core as layers_core
 from baseline.utils import lookup_sentence, beam_multinomial
@@ -53,6 +54,27 @@ def optimizer(loss_fn, **kwargs):
     return global_step, tf.contrib.layers.optimize_loss(loss_fn, global_step, eta, optz, clip_gradients=clip, learning_rate_decay_fn=decay_fn)
 
 
+# The weights to feed to the initializer of each `embedding_variable`, per graph
+_EMBEDDING_INITS = weakref.WeakKeyDictionary()
+
+
+def embedding_variable(x2vec, name, trainable=True):
+    """A variable holding a lookup table, initialized with `x2vec.weights`
+
+    The weights are fed in when the initializer runs (see `embedding_init_feed`) rather than stored in the graph as a
+    `tf.constant`, which would keep another copy of them for as long as the graph lives, and cannot exceed 2GB
+    """
+    init = tf.placeholder(tf.float32, x2vec.weights.shape, name=name + '_init')
+    _EMBEDDING_INITS.setdefault(tf.get_default_graph(), {})[init] = x2vec.weights
+    return tf.Variable(init, name=name, trainable=trainable)
+
+
+def embedding_init_feed(graph=None):
+    """The feed needed to run the initializers of the `embedding_variable`s in a graph"""
+    graph = tf.get_default_graph() if graph is None else graph
+    return dict(_EMBEDDING_INITS.get(graph, {}))
+
+
 def tensor2seq(tensor):
     return tf.unstack(tf.transpose(tensor, perm=[1, 0, 2]))
 
@@ -1,62 +1,347 @@
+import baseline.reader
 import numpy as np
+import mmap
+import multiprocessing
+from collections import Counter
+import hashlib
+import codecs
+import json
+import os
+import glob
+import atexit
+
+
+# Bump this whenever the layout of the cached embeddings changes
+EMBEDDING_CACHE_VERSION = 1
+
+# How much of an embeddings file is hashed to key its cache entries, see `_cache_key`
+CACHE_SAMPLES = 64
+CACHE_SAMPLE_BYTES = 64 * 1024
+
+
+def _cache_key(filename, known_vocab, keep_unused, full_hash=False):
+    """Name the cache entry for the vectors kept from an embeddings file
+
+    Hashing all of a multi-gigabyte file would take about as long as reading it, so by default only its size,
+    its modification time and `CACHE_SAMPLES` blocks spread evenly through it are hashed.  With `full_hash`, all
+    of it is hashed instead, and the time is left out, so an entry then survives copying the file as well as
+    moving it.  The entry does not depend on the file's name or location.  Unless `keep_unused` is set, the
+    words of `known_vocab` are part of the key too, because they decide which rows are kept
+    """
+    h = hashlib.sha1(('%d %s %s' % (EMBEDDING_CACHE_VERSION, keep_unused, full_hash)).encode('utf-8'))
+    stat = os.stat(filename)
+    with open(filename, 'rb') as f:
+        if full_hash:
+            for block in iter(lambda: f.read(CACHE_SAMPLES * CACHE_SAMPLE_BYTES), b''):
+                h.update(block)
+        else:
+            h.update(('%d %d' % (stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+            for k in range(CACHE_SAMPLES):
+                f.seek(k * max(stat.st_size - CACHE_SAMPLE_BYTES, 0) // (CACHE_SAMPLES - 1))
+                h.update(f.read(CACHE_SAMPLE_BYTES))
+    if not keep_unused and known_vocab is not None:
+        h.update('\n'.join(sorted(known_vocab)).encode('utf-8'))
+    return h.hexdigest()
+
+
+# The shared weight files this process holds a reference to, see `_share_weights`
+_shared_refs = set()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _release_weights(name, ref):
+    """Drop this process's reference to a shared weight file, and remove the file if no live process holds one"""
+    try:
+        os.remove(ref)
+    except OSError:
+        pass
+    for other in glob.glob(glob.escape(name) + '.*.ref'):
+        if _pid_alive(int(other.split('.')[-2])):
+            return
+        # Left by a process that was killed before it could clean up
+        try:
+            os.remove(other)
+        except OSError:
+            pass
+    try:
+        os.remove(name + '.npy')
+    except OSError:
+        pass
+
+
+def _write_shared(weights, name):
+    # Write under a temporary name and rename, so a concurrent process never maps a partial file
+    tmp = '%s.%d.tmp.npy' % (name, os.getpid())
+    np.save(tmp, weights)
+    os.replace(tmp, name + '.npy')
+
+
+def _share_weights(weights, dirname):
+    """Write embedding weights to a float32 `.npy` file in `dirname`, named by a hash of their contents, and map it
+
+    Every process sharing the same weights maps the same file, so between them they hold a single copy.  Each of them
+    marks its use with a `<name>.<pid>.ref` file beside it, and the last to exit removes the weights
+    """
+    weights = np.ascontiguousarray(weights, dtype=np.float32)
+    h = hashlib.sha1(str(weights.shape).encode('utf-8'))
+    h.update(weights.data)
+    name = os.path.join(dirname, h.hexdigest())
+    shared = name + '.npy'
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Made by a concurrent process
+            pass
+    # Take the reference before looking for the file, so a process exiting now cannot remove it under us
+    ref = '%s.%d.ref' % (name, os.getpid())
+    open(ref, 'w').close()
+    if ref not in _shared_refs:
+        _shared_refs.add(ref)
+        atexit.register(_release_weights, name, ref)
+    if not os.path.exists(shared):
+        _write_shared(weights, name)
+    try:
+        return np.load(shared, mmap_mode='r')
+    except (IOError, OSError):
+        # Removed by a process that exited just before we took our reference
+        _write_shared(weights, name)
+        return np.load(shared, mmap_mode='r')
+
+
+def cow_weights(weights):
+    """A private, copy-on-write float32 array of embedding weights, to initialize a lookup table with
+
+    If the weights are mapped from a `.npy` file (see `share()`, or a `Word2VecModel` loaded from `cache_dir`), the file
+    is mapped again, so the result shares memory with every other mapping of it until its rows are written.  Otherwise,
+    the weights are copied.  Either way, writing to the result never changes `weights`
+    """
+    if isinstance(weights, np.memmap) and weights.dtype == np.float32 and str(weights.filename).endswith('.npy'):
+        view = np.load(weights.filename, mmap_mode='c')
+        # A slice of the mapped file has a different shape, and has to be copied
+        if view.shape == weights.shape:
+            return view
+    return np.array(weights, dtype=np.float32)
+
+
+class QuantizedWeights(object):
+    """Embedding weights held as float16, or as int8 with one float32 scale per row
+
+    Reading rows (`weights[ids]`) converts only those rows back to float32, and `np.asarray(weights)` converts the
+    whole table, for frameworks that need it as floats.  float16 halves the memory of float32 weights, and int8, which
+    maps each row's largest magnitude to 127, quarters it (less the scales)
+    """
+    STORAGE = ('float16', 'int8')
+
+    def __init__(self, weights, storage='int8'):
+        if storage not in QuantizedWeights.STORAGE:
+            raise ValueError('Unknown embedding storage %s, expected one of %s' % (storage, QuantizedWeights.STORAGE))
+        weights = np.asarray(weights, dtype=np.float32)
+        self.storage = storage
+        if storage == 'float16':
+            self.codes = weights.astype(np.float16)
+            self.scales = None
+        else:
+            scales = np.abs(weights).max(axis=1) / 127.0
+            # All-zero rows, like padding, would otherwise divide by zero
+            scales[scales == 0] = 1.0
+            self.codes = np.round(weights / scales[:, np.newaxis]).astype(np.int8)
+            self.scales = scales.astype(np.float32)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        rest = ()
+        if isinstance(index, tuple):
+            index, rest = index[0], index[1:]
+        rows = self.codes[index].astype(np.float32)
+        if self.scales is not None:
+            rows *= np.expand_dims(self.scales[index], -1)
+        return rows[(Ellipsis,) + rest] if rest else rows
+
+    def __array__(self, dtype=None):
+        weights = self[:]
+        return weights if dtype is None else weights.astype(dtype)
 
 
 class Word2VecModel:
 
-    def __init__(self, filename, known_vocab=None, unif_weight=None, keep_unused=False):
+    # Vectors are gathered out of the file this many at a time, bounding the size of the gather index
+    GATHER_ROWS = 4096
 
+    def __init__(self, filename, known_vocab=None, unif_weight=None, keep_unused=False, cache_dir=None,
+                 full_hash=False):
+        """
+        :param cache_dir: If given, keep the rows read from `filename` in this directory, and on later runs with the
+            same file and words, memory-map them from there rather than reading the file.  Vectors for words missing
+            from the file are still drawn afresh each time
+        :param full_hash: Recognize the file in `cache_dir` by a hash of all of it, rather than of its size,
+            modification time and some sampled blocks (see `_cache_key`)
+        """
         uw = 0.0 if unif_weight is None else unif_weight
-        self.vocab = {}
-        idx = 0
 
+        words = None
+        if cache_dir is not None:
+            cache = os.path.join(cache_dir, _cache_key(filename, known_vocab, keep_unused, full_hash))
+            words, vectors = Word2VecModel._load_cached(cache)
+        if words is None:
+            words, vectors = self._read_vectors(filename, known_vocab, keep_unused)
+            if cache_dir is not None:
+                Word2VecModel._save_cached(cache, words, vectors)
+
+        self.dsz = vectors.shape[1]
+        self.nullv = np.zeros(self.dsz, dtype=np.float32)
+        self.vocab = {"<PADDING>": 0}
+        for idx, word in enumerate(words):
+            # Remove it from knownvocab
+            if known_vocab and word in known_vocab:
+                known_vocab[word] = 0
+            self.vocab[word] = idx + 1
+
+        unknown = []
+        if known_vocab is not None:
+            unknown = [v for v, cnt in known_vocab.items() if cnt > 0]
+
+        idx = len(vectors)
+        if unknown:
+            # Random vectors are drawn as doubles, and as before, they promote the whole matrix
+            self.weights = np.zeros((idx + len(unknown), self.dsz), dtype=np.float64)
+            self.weights[:idx] = vectors
+        else:
+            self.weights = vectors
+
+        for v in unknown:
+            self.weights[idx] = np.random.uniform(-uw, uw, self.dsz)
+            self.vocab[v] = idx
+            idx += 1
+
+        self.vsz = self.weights.shape[0] - 1
+
+    @staticmethod
+    def _read_vectors(filename, known_vocab, keep_unused):
+        """Read the words of a word2vec binary file that are in `known_vocab` (or all of them, with `keep_unused`)
+
+        :return: The list of words kept, and a float32 matrix of their vectors, after a row of zeros for padding
+        """
         with open(filename, "rb") as f:
             header = f.readline()
-            vsz, self.dsz = map(int, header.split())
+            vsz, dsz = map(int, header.split())
+            width = 4 * dsz
 
-            self.nullv = np.zeros(self.dsz, dtype=np.float32)
-            self.vocab["<PADDING>"] = idx
-            idx += 1
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                words, starts = Word2VecModel._index_records(data, len(header), vsz, width)
+                kept = []
+                rows = []
+                for word, start in zip(words, starts):
+                    if keep_unused is False and word not in known_vocab:
+                        continue
+                    kept.append(word)
+                    rows.append(start)
 
-            word_vectors = [self.nullv]
-            width = 4 * self.dsz
+                vectors = np.zeros((len(rows) + 1, dsz), dtype=np.float32)
+                Word2VecModel._gather(data, np.array(rows, dtype=np.int64), width, vectors[1:])
+            finally:
+                data.close()
+        return kept, vectors
 
-            for i in range(vsz):
-                word = Word2VecModel._readtospc(f)
-                raw = f.read(width)
-                if keep_unused is False and word not in known_vocab:
-                    continue
+    @staticmethod
+    def _load_cached(cache):
+        """Load the words and vectors saved by `_save_cached`, or `(None, None)` if there are none
 
-                # Otherwise add it to the list and remove from knownvocab
-                if known_vocab and word in known_vocab:
-                    known_vocab[word] = 0
+        The vectors are memory-mapped copy-on-write, so they load at once, and writing to them never touches the cache
+        """
+        if not os.path.exists(cache + '.npy') or not os.path.exists(cache + '.json'):
+            return None, None
+        with codecs.open(cache + '.json', encoding='utf-8', mode='r') as f:
+            words = json.load(f)
+        return words, np.load(cache + '.npy', mmap_mode='c')
 
-                vec = np.fromstring(raw, dtype=np.float32)
-                word_vectors.append(vec)
+    @staticmethod
+    def _save_cached(cache, words, vectors):
+        try:
+            if not os.path.exists(os.path.dirname(cache)):
+                os.makedirs(os.path.dirname(cache))
+            # Write under temporary names and rename, so a concurrent run never sees a partial entry
+            tmp = '%s.%d.tmp' % (cache, os.getpid())
+            with codecs.open(tmp + '.json', encoding='utf-8', mode='w') as f:
+                json.dump(words, f, ensure_ascii=False)
+            np.save(tmp + '.npy', vectors)
+            os.rename(tmp + '.json', cache + '.json')
+            os.rename(tmp + '.npy', cache + '.npy')
+        except (IOError, OSError):
+            # e.g. a read-only directory, which just means reading the embeddings again next time
+            pass
 
-                self.vocab[word] = idx
-                idx += 1
+    @staticmethod
+    def _index_records(data, offset, vsz, width):
+        """Find the word and the start of the vector of every record in a memory-mapped word2vec binary file
 
-        if known_vocab is not None:
-            unknown = {v: cnt for v,cnt in known_vocab.items() if cnt > 0}
-            for v in unknown:
-                word_vectors.append(np.random.uniform(-uw, uw, self.dsz))
-                self.vocab[v] = idx
-                idx += 1
+        The vectors are binary and may hold spaces themselves, so each record's word is found by searching for
+        the space after it, and then its vector is skipped over
 
-        self.weights = np.array(word_vectors)
-        self.vsz = self.weights.shape[0] - 1
+        :return: The list of words and an array of the byte offsets of their vectors
+        """
+        words = []
+        starts = np.zeros(vsz, dtype=np.int64)
+        find = data.find
+        for i in range(vsz):
+            space = find(b'\x20', offset)
+            if space < 0:
+                raise ValueError('Expected %d vectors, but the file ends after %d' % (vsz, i))
+            # Any newline ending the previous record is stripped along with the rest of the whitespace
+            words.append(data[offset:space].decode('utf-8').strip())
+            starts[i] = space + 1
+            offset = space + 1 + width
+        return words, starts
 
     @staticmethod
-    def _readtospc(f):
+    def _gather(data, starts, width, out):
+        """Copy the float32 vectors at byte offsets `starts` of `data` into the rows of `out`"""
+        raw = np.frombuffer(data, dtype=np.uint8)
+        columns = np.arange(width, dtype=np.int64)
+        for i in range(0, len(starts), Word2VecModel.GATHER_ROWS):
+            chunk = starts[i:i + Word2VecModel.GATHER_ROWS]
+            out[i:i + len(chunk)] = raw[chunk[:, np.newaxis] + columns].view(np.float32)
+        del raw
 
-        s = bytearray()
-        ch = f.read(1)
+    def share(self, dirname):
+        """Hold the weights in a read-only, memory-mapped float32 file in `dirname`, named by a hash of their contents
 
-        while ch != b'\x20':
-            s.extend(ch)
-            ch = f.read(1)
-        s = s.decode('utf-8')
-        return s.strip()
+        Use a memory-backed directory such as `/dev/shm`.  Processes that build the same weights (the same embeddings,
+        vocabulary and seed) then share one copy of them, and lookup tables made with `cow_weights()` only copy the
+        pages they write to
+        """
+        self.weights = _share_weights(self.weights, dirname)
+
+    def quantize(self, storage):
+        """Hold the weights as `float16`, or as `int8` with a scale per row, converting rows to float32 as they are read
+
+        See `QuantizedWeights`.  Sharing quantized weights with `share()` would convert them back to float32
+        """
+        self.weights = QuantizedWeights(self.weights, storage)
 
     def lookup(self, word, nullifabsent=True):
         if word in self.vocab:
@@ -66,6 +351,134 @@ class Word2VecModel:
         return self.nullv
 
 
+# The words to keep, set in each worker of a `TextVecModel` pool so they are sent once rather than with every chunk
+_text_filter = None
+
+
+def _set_text_filter(known_words):
+    global _text_filter
+    _text_filter = known_words
+
+
+def _text_chunk_vectors(task):
+    """Parse the lines of a text embeddings file that start in a byte range, keeping those in `_text_filter`
+
+    Lines are split on newlines only, since `splitlines()` also breaks on characters that some vocabularies hold.
+    A word is everything before the last `dsz` fields, so words containing spaces survive
+
+    :return: The list of words kept and a float32 matrix of their vectors
+    """
+    filename, start, end, dsz = task
+    with open(filename, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        data = f.read(max(end - pos, 0))
+        if data and not data.endswith(b'\n'):
+            data += f.readline()
+    words = []
+    values = []
+    for line in data.split(b'\n'):
+        line = line.rstrip()
+        if not line:
+            continue
+        if line.count(b' ') == dsz:
+            # The usual case, a word without spaces, where only the word needs decoding
+            space = line.index(b' ')
+            word, vector = line[:space].decode('utf-8'), line[space + 1:]
+        else:
+            fields = line.decode('utf-8').rsplit(' ', dsz)
+            if len(fields) != dsz + 1:
+                raise ValueError('Expected a word and %d values in %s, but got %r' % (dsz, filename, line[:80]))
+            word, vector = fields[0], ' '.join(fields[1:]).encode('utf-8')
+        if _text_filter is not None and word not in _text_filter:
+            continue
+        words.append(word)
+        values.append(vector)
+    vectors = np.fromstring(b' '.join(values), dtype=np.float32, sep=' ')
+    return words, vectors.reshape(len(words), dsz)
+
+
+class TextVecModel(Word2VecModel):
+    """Embeddings from a text file, with one word and its values per line, as written by GloVe or fastText (`.vec`)
+
+    A first line of just two integers, the vocab size and the dimension, is skipped.  With `workers`, the file is
+    parsed in byte-range chunks in a process pool, and each worker only sends back the rows that `known_vocab` keeps
+    """
+    # Without a header, the dimension is taken from this many lines at the top of the file
+    SNIFF_LINES = 100
+
+    def __init__(self, filename, known_vocab=None, unif_weight=None, keep_unused=False, cache_dir=None,
+                 full_hash=False, workers=1):
+        self.workers = workers
+        Word2VecModel.__init__(self, filename, known_vocab, unif_weight, keep_unused, cache_dir, full_hash)
+
+    def _read_vectors(self, filename, known_vocab, keep_unused):
+        if baseline.reader._compression(filename) is not None:
+            raise ValueError('%s is compressed, decompress it first' % filename)
+        with open(filename, 'rb') as f:
+            head = [f.readline() for _ in range(TextVecModel.SNIFF_LINES)]
+        fields = head[0].decode('utf-8').rstrip().split(' ')
+        if len(fields) == 2 and all(field.isdigit() for field in fields):
+            body, dsz = len(head[0]), int(fields[1])
+        else:
+            # A few words hold spaces, so go by the most common number of fields
+            counts = Counter(len(line.decode('utf-8').rstrip().split(' ')) for line in head if line.strip())
+            body, dsz = 0, counts.most_common(1)[0][0] - 1
+
+        known_words = None if keep_unused is not False else frozenset(known_vocab)
+        # Even in one process, the file is parsed a chunk at a time, so only the rows kept pile up
+        tasks = [(filename, max(start, body), end, dsz)
+                 for start, end in baseline.reader._byte_ranges(filename, self.workers) if end > body]
+        if self.workers > 1:
+            pool = multiprocessing.Pool(self.workers, _set_text_filter, (known_words,))
+            try:
+                parts = pool.map(_text_chunk_vectors, tasks)
+            finally:
+                pool.terminate()
+        else:
+            _set_text_filter(known_words)
+            try:
+                parts = [_text_chunk_vectors(task) for task in tasks]
+            finally:
+                _set_text_filter(None)
+
+        words = [word for part_words, _ in parts for word in part_words]
+        return words, np.concatenate([np.zeros((1, dsz), dtype=np.float32)] + [part for _, part in parts])
+
+
+def _is_text_embeddings(filename):
+    """Whether an embeddings file is text (GloVe, fastText) rather than a word2vec binary
+
+    Both may start with a `vsz dsz` header, but only a word2vec binary must, and only in a text file does the first
+    record end in `dsz` numbers
+    """
+    with open(filename, 'rb') as f:
+        fields = f.readline().split()
+        if len(fields) != 2 or not all(field.isdigit() for field in fields):
+            return True
+        dsz = int(fields[1])
+        values = f.readline().rstrip().split(b' ')[1:][-dsz:]
+    try:
+        [float(value) for value in values]
+    except ValueError:
+        return False
+    return len(values) == dsz
+
+
+def load_embeddings(filename, known_vocab=None, unif_weight=None, keep_unused=False, cache_dir=None, full_hash=False,
+                    workers=1):
+    """Load pre-trained embeddings, as a `TextVecModel` if the file is text and as a `Word2VecModel` otherwise
+
+    :param workers: The number of processes to parse a text file in
+    :return: Either model, which share an interface
+    """
+    if _is_text_embeddings(filename):
+        return TextVecModel(filename, known_vocab, unif_weight, keep_unused, cache_dir, full_hash, workers)
+    return Word2VecModel(filename, known_vocab, unif_weight, keep_unused, cache_dir, full_hash)
+
+
 class RandomInitVecModel:
 
     def __init__(self, dsz, known_vocab, counts=True, unif_weight=None):
@@ -91,6 +504,22 @@ class RandomInitVecModel:
         self.nullv = np.zeros(self.dsz, dtype=np.float32)
         self.weights[0] = self.nullv
 
+    def share(self, dirname):
+        """Hold the weights in a read-only, memory-mapped float32 file in `dirname`, named by a hash of their contents
+
+        Use a memory-backed directory such as `/dev/shm`.  Processes that build the same weights (the same embeddings,
+        vocabulary and seed) then share one copy of them, and lookup tables made with `cow_weights()` only copy the
+        pages they write to
+        """
+        self.weights = _share_weights(self.weights, dirname)
+
+    def quantize(self, storage):
+        """Hold the weights as `float16`, or as `int8` with a scale per row, converting rows to float32 as they are read
+
+        See `QuantizedWeights`.  Sharing quantized weights with `share()` would convert them back to float32
+        """
+        self.weights = QuantizedWeights(self.weights, storage)
+
     def lookup(self, word, nullifabsent=True):
         if word in self.vocab:
             return self.weights[self.vocab[word]]
@@ -7,10 +7,16 @@ parser = argparse.ArgumentParser(description='Train a text classifier')
 parser.add_argument('--visdom', help='Turn on visdom reporting', type=bool, default=False)
 parser.add_argument('--eta', help='Initial learning rate', default=0.01, type=float)
 parser.add_argument('--mom', help='SGD Momentum', default=0.9, type=float)
-parser.add_argument('--embed', help='Word2Vec embeddings file', required=True)
-parser.add_argument('--train', help='Training file', required=True)
+parser.add_argument('--embed', help='Word2Vec binary or GloVe/fastText text embeddings file', required=True)
+parser.add_argument('--embed_cache', default=None, help='Directory to cache the vectors kept from the embeddings in, so later runs load them at once')
+parser.add_argument('--embed_cache_full_hash', default=False, action='store_true', help='Recognize cached embeddings by a hash of the whole file, rather than its size, modification time and sampled blocks')
+parser.add_argument('--share_embed', default=None, help='Hold the embedding weights in a memory-mapped file in this directory (e.g. /dev/shm), shared by every process that builds the same weights')
+parser.add_argument('--embed_storage', default='float32', choices=['float32', 'float16', 'int8'], help='Hold the embedding tables as float16, or as int8 with a scale per row (frozen PyTorch tables stay that way)')
+parser.add_argument('--seed', default=None, type=int, help='Seed numpy\'s random number generator, so that every run draws the same random vectors (required by --share_embed)')
+parser.add_argument('--train', help='Training file')
 parser.add_argument('--valid', help='Validation file')
-parser.add_argument('--test', help='Test file', required=True)
+parser.add_argument('--test', help='Test file')
+parser.add_argument('--dataset', help='Preprocessed dataset directory (see preprocess.py), instead of train/valid/test')
 parser.add_argument('--save', help='Save basename', default='classify_sentence_pytorch')
 parser.add_argument('--nogpu', help='Do not use GPU', default=False)
 parser.add_argument('--optim', help='Optim method', default='adam', choices=['adam', 'adagrad', 'adadelta', 'sgd'])
@@ -30,15 +36,31 @@ parser.add_argument('--backend', help='Which deep learning framework to use', de
 parser.add_argument('--keep_unused', help='Keep unused vocabulary terms as word vectors', default=False)
 parser.add_argument('--do_early_stopping', help='Should we do early stopping?', default=True, type=bool)
 parser.add_argument('--early_stopping_metric', help='What metric should we use if stopping early', default='acc')
+parser.add_argument('--buckets', default=None, nargs='+', type=int, help='Batch examples of similar length together: either a number of buckets, or the bucket edges')
+parser.add_argument('--prefetch', default=0, type=int, help='Build this many batches ahead on a background thread')
+parser.add_argument('--max_tokens', default=None, type=int, help='Instead of batchsz examples, batch as many as fit in this many (padded) tokens')
+parser.add_argument('--workers', default=1, type=int, help='Build batches in this many processes')
+parser.add_argument('--vocab_workers', default=1, help='Processes to use for building the vocabulary, and for parsing text embeddings', type=int)
+parser.add_argument('--lazy', default=False, action='store_true', help='Index the files and only read lines as batches need them')
 
 args = parser.parse_args()
+if args.dataset is None and (args.train is None or args.test is None):
+    parser.error('Either --dataset or both --train and --test are required')
+if args.share_embed is not None and args.embed_storage != 'float32':
+    parser.error('--share_embed cannot be combined with --embed_storage')
+if args.share_embed is not None and args.seed is None:
+    parser.error('--share_embed requires --seed, or each process draws different random vectors and shares nothing')
+if args.seed is not None:
+    np.random.seed(args.seed)
 
 
 if args.backend == 'pytorch':
     from baseline.pytorch import long_0_tensor_alloc as vec_alloc
     import baseline.pytorch.classify as classify
     zeropadding = np.max(args.filtsz)
+    trim = True
 else:
+    trim = False
     # Everything else uses numpy
     from numpy import zeros as vec_alloc
     if args.backend == 'keras':
@@ -51,22 +73,49 @@ else:
 
 args.reporting = setup_reporting(args.visdom)
 
+buckets = None if args.buckets is None else args.buckets[0] if len(args.buckets) == 1 else args.buckets
+batch_args = {'buckets': buckets, 'max_tokens': args.max_tokens, 'workers': args.workers}
 clean_fn = TSVSeqLabelReader.do_clean if args.clean else None, vec_alloc
 print(clean_fn)
-reader = TSVSeqLabelReader(args.mxlen, zeropadding, vec_alloc=vec_alloc)
-vocab = reader.build_vocab([args.train, args.test, args.valid])
 unif = 0 if args.static else args.unif
-embeddings = Word2VecModel(args.embed, vocab, unif, keep_unused=args.keep_unused)
 
-ts = reader.load(args.train, embeddings.vocab, args.batchsz, shuffle=True)
-print('Loaded training data')
+if args.dataset is not None:
+    dataset = Dataset(args.dataset)
+    if dataset.params['mxlen'] != args.mxlen or dataset.params['mxfiltsz'] != zeropadding:
+        raise ValueError('Dataset was preprocessed with mxlen %d, zeropadding %d' %
+                         (dataset.params['mxlen'], dataset.params['mxfiltsz']))
+    embeddings = load_embeddings(args.embed, dataset.vocabs['word'], unif, keep_unused=args.keep_unused,
+                                 cache_dir=args.embed_cache, full_hash=args.embed_cache_full_hash,
+                                 workers=args.vocab_workers)
+    dataset.check_index('word', embeddings.vocab)
+    ts = dataset.load('train', args.batchsz, shuffle=True, trim=trim, **batch_args)
+    vs = dataset.load('valid', args.batchsz, trim=trim, **batch_args)
+    es = dataset.load('test', 2, trim=trim, **batch_args)
+    print('Loaded preprocessed data')
+    label2index = dataset.label2index
+else:
+    reader = TSVSeqLabelReader(args.mxlen, zeropadding, vec_alloc=vec_alloc)
+    vocab = reader.build_vocab([args.train, args.test, args.valid], keep_tokens=not args.lazy, workers=args.vocab_workers)
+    embeddings = load_embeddings(args.embed, vocab, unif, keep_unused=args.keep_unused, cache_dir=args.embed_cache,
+                                 full_hash=args.embed_cache_full_hash, workers=args.vocab_workers)
+    load = reader.load_lazy if args.lazy else reader.load
+
+    ts = load(args.train, embeddings.vocab, args.batchsz, shuffle=True, trim=trim, **batch_args)
+    print('Loaded training data')
 
-vs = reader.load(args.valid, embeddings.vocab, args.batchsz)
-print('Loaded valid data')
+    vs = load(args.valid, embeddings.vocab, args.batchsz, trim=trim, **batch_args)
+    print('Loaded valid data')
 
-es = reader.load(args.test, embeddings.vocab, 2)
-print('Loaded test data')
-labels = list(revlut(reader.label2index))
+    es = load(args.test, embeddings.vocab, 2, trim=trim, **batch_args)
+    print('Loaded test data')
+    label2index = reader.label2index
+if args.share_embed is not None:
+    embeddings.share(args.share_embed)
+elif args.embed_storage != 'float32':
+    embeddings.quantize(args.embed_storage)
+labels = list(revlut(label2index))
+if args.prefetch > 0:
+    ts, vs, es = [PrefetchDataFeed(feed, args.prefetch) for feed in (ts, vs, es)]
 
 model = classify.create_model(embeddings, labels, filtsz=args.filtsz, cmotsz=args.cmotsz, dropout=args.dropout, finetune=not args.static)
 classify.fit(model, ts, vs, es, **vars(args))
@@ -0,0 +1,104 @@
+import argparse
+from baseline import *
+
+parser = argparse.ArgumentParser(description='Preprocess a corpus into a memory-mappable dataset')
+parser.add_argument('--task', help='Which task the data is for', required=True, choices=sorted(TASK_COLUMNS.keys()))
+parser.add_argument('--outdir', help='Directory to write the dataset to', required=True)
+parser.add_argument('--train', help='Training file')
+parser.add_argument('--valid', help='Validation file')
+parser.add_argument('--test', help='Test file')
+parser.add_argument('--embed', help='Word2Vec binary or GloVe/fastText text embeddings file (required for classify and tagger, optional for lm)')
+parser.add_argument('--embed1', help='Word2Vec binary or GloVe/fastText text embeddings file (1) (seq2seq)')
+parser.add_argument('--embed2', help='Word2Vec binary or GloVe/fastText text embeddings file (2) (seq2seq)')
+parser.add_argument('--embed_cache', default=None, help='Directory to cache the vectors kept from the embeddings in, so later runs load them at once')
+parser.add_argument('--embed_cache_full_hash', default=False, action='store_true', help='Recognize cached embeddings by a hash of the whole file, rather than its size, modification time and sampled blocks')
+parser.add_argument('--keep_unused', help='Keep unused vocabulary terms as word vectors (classify)', default=False)
+parser.add_argument('--char', default=False, help='Use character-level modeling (lm)', type=bool)
+parser.add_argument('--mxlen', help='Max length (default is the task default)', type=int)
+parser.add_argument('--mxwlen', default=40, help='Max word length (tagger, lm)', type=int)
+parser.add_argument('--zeropadding', default=0, help='Zero padding on each side, max filter size (classify)', type=int)
+parser.add_argument('--clean', help='Do cleaning (classify)', action='store_true', default=False)
+parser.add_argument('--web_cleanup', default=False, help='Do cleanup of web tokens? (tagger)', type=bool)
+parser.add_argument('--pair_suffix', default=None, nargs='+', help='list of suffixes to give if parallel corpora (seq2seq)')
+parser.add_argument('--vocab', default=None, help='vocab (basename) file to give if it exists (seq2seq)')
+parser.add_argument('--vocab_workers', default=1, help='Processes to use for building the vocabulary, and for parsing text embeddings', type=int)
+args = parser.parse_args()
+
+# The classify and tagger programs index words only through the embeddings' vocabulary
+if args.task in ('classify', 'tagger') and args.embed is None:
+    parser.error('--embed is required for the %s task' % args.task)
+
+files = {'train': args.train, 'valid': args.valid, 'test': args.test}
+files = {split: filename for split, filename in files.items() if filename is not None}
+
+# Each task below mirrors how its training program builds the vocabularies, so the
+# indices written out are the same ones that program would produce.  It will check that they match.
+if args.task == 'classify':
+    mxlen = 100 if args.mxlen is None else args.mxlen
+    clean_fn = TSVSeqLabelReader.do_clean if args.clean else None
+    reader = TSVSeqLabelReader(mxlen, args.zeropadding, clean_fn=clean_fn)
+    vocab = reader.build_vocab([args.train, args.test, args.valid], keep_tokens=True)
+    vocabs = {'word': Counter(vocab)}
+    embeddings = load_embeddings(args.embed, vocab, 0, keep_unused=args.keep_unused, cache_dir=args.embed_cache,
+                                 full_hash=args.embed_cache_full_hash, workers=args.vocab_workers)
+    splits = {}
+    for split, filename in files.items():
+        splits[split] = reader.load_examples(filename, embeddings.vocab)
+    write_dataset(args.outdir, args.task, splits, vocabs, {'word': embeddings.vocab},
+                  reader.label2index, {'mxlen': mxlen, 'mxfiltsz': args.zeropadding})
+
+elif args.task == 'tagger':
+    mxlen = -1 if args.mxlen is None else args.mxlen
+    word_trans_fn = None if not args.web_cleanup else CONLLSeqReader.web_cleanup
+    reader = CONLLSeqReader(mxlen, args.mxwlen, word_trans_fn=word_trans_fn)
+    vocab_ch, vocab_word = reader.build_vocab([args.train, args.test, args.valid], workers=args.vocab_workers)
+    vocabs = {'word': Counter(vocab_word), 'char': Counter(vocab_ch)}
+    word_vocab = load_embeddings(args.embed, vocab_word, cache_dir=args.embed_cache,
+                                 full_hash=args.embed_cache_full_hash, workers=args.vocab_workers).vocab
+    char_vocab = RandomInitVecModel(1, vocab_ch).vocab
+    splits = {}
+    for split, filename in files.items():
+        ex, _ = reader.load_examples(filename, word_vocab, char_vocab)
+        splits[split] = (ex.words, ex.chars, ex.tags, ex.offsets, ex.char_offsets, ex.ids)
+    write_dataset(args.outdir, args.task, splits, vocabs, {'word': word_vocab, 'char': char_vocab},
+                  reader.label2index, {'max_sentence_length': reader.max_sentence_length,
+                                       'max_word_length': reader.max_word_length})
+
+elif args.task == 'seq2seq':
+    mxlen = 1000 if args.mxlen is None else args.mxlen
+    if args.pair_suffix is not None and args.vocab is not None:
+        reader = MultiFileParallelCorpusReader(args.pair_suffix[0], args.pair_suffix[1], mxlen)
+        vocab_list = [args.vocab]
+    else:
+        reader = TSVParallelCorpusReader(mxlen)
+        vocab_list = [args.train, args.test]
+    vocab1, vocab2 = reader.build_vocabs(vocab_list, workers=args.vocab_workers)
+    vocabs = {'src': Counter(vocab1), 'dst': Counter(vocab2)}
+    vocab_src = load_embeddings(args.embed1, vocab1, cache_dir=args.embed_cache,
+                                full_hash=args.embed_cache_full_hash, workers=args.vocab_workers).vocab if args.embed1 else RandomInitVecModel(1, vocab1).vocab
+    vocab_dst = load_embeddings(args.embed2, vocab2, cache_dir=args.embed_cache,
+                                full_hash=args.embed_cache_full_hash, workers=args.vocab_workers).vocab if args.embed2 else RandomInitVecModel(1, vocab1).vocab
+    splits = {}
+    for split, filename in files.items():
+        ex = reader.load_examples(filename, vocab_src, vocab_dst)
+        splits[split] = (ex.src, ex.tgt, ex.src_offsets, ex.tgt_offsets)
+    write_dataset(args.outdir, args.task, splits, vocabs, {'src': vocab_src, 'dst': vocab_dst},
+                  params={'max_sentence_length': mxlen})
+
+else:
+    reader = PTBSeqReader(args.mxwlen, 0)
+    vocab_ch, vocab_word, num_words = reader.build_vocab([args.train, args.valid, args.test], workers=args.vocab_workers)
+    vocabs = {'word': Counter(vocab_word), 'char': Counter(vocab_ch)}
+    if args.embed and args.char is False:
+        word_vocab = load_embeddings(args.embed, vocab_word, cache_dir=args.embed_cache,
+                                     full_hash=args.embed_cache_full_hash, workers=args.vocab_workers).vocab
+    else:
+        word_vocab = RandomInitVecModel(1, vocab_word).vocab
+    char_vocab = RandomInitVecModel(1, vocab_ch).vocab
+    num_words = dict(zip([split for split in ['train', 'valid', 'test'] if split in files], num_words))
+    splits = {split: reader.load_examples(filename, word_vocab, char_vocab, num_words[split])
+              for split, filename in files.items()}
+    write_dataset(args.outdir, args.task, splits, vocabs, {'word': word_vocab, 'char': char_vocab},
+                  params={'max_word_length': reader.max_word_length, 'num_words': num_words})
+
+print('Wrote %s dataset to %s' % (args.task, args.outdir))
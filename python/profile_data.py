@@ -0,0 +1,149 @@
+import argparse
+import json
+from baseline import *
+
+parser = argparse.ArgumentParser(description='Profile a corpus and recommend max lengths and bucket edges')
+parser.add_argument('--task', help='Which task the data is for', required=True, choices=sorted(TASK_COLUMNS.keys()))
+parser.add_argument('--train', help='Training file', required=True)
+parser.add_argument('--valid', help='Validation file')
+parser.add_argument('--test', help='Test file')
+parser.add_argument('--embed', help='Word2Vec binary or GloVe/fastText text embeddings file to measure the OOV rate against (classify, tagger, lm)')
+parser.add_argument('--embed1', help='Word2Vec binary or GloVe/fastText text embeddings file (1) to measure the OOV rate against (seq2seq)')
+parser.add_argument('--embed2', help='Word2Vec binary or GloVe/fastText text embeddings file (2) to measure the OOV rate against (seq2seq)')
+parser.add_argument('--clean', help='Do cleaning (classify)', action='store_true', default=False)
+parser.add_argument('--zeropadding', default=0, help='Zero padding the classifier adds around each example, as its largest filter size (classify, pytorch and keras)', type=int)
+parser.add_argument('--web_cleanup', default=False, help='Do cleanup of web tokens? (tagger)', type=bool)
+parser.add_argument('--pair_suffix', default=None, nargs='+', help='list of suffixes to give if parallel corpora (seq2seq)')
+parser.add_argument('--batchsz', default=50, help='Batch size to project the padding for', type=int)
+parser.add_argument('--mxlen', help='Max length to compare against (default is the task default)', type=int)
+parser.add_argument('--mxwlen', default=40, help='Max word length to compare against (tagger, lm)', type=int)
+parser.add_argument('--percentile', default=99, help='Recommend the max length that covers this percent of examples', type=float)
+parser.add_argument('--wpercentile', default=99.9, help='Recommend the max word length that covers this percent of tokens', type=float)
+parser.add_argument('--buckets', default=8, help='How many bucket edges to recommend', type=int)
+parser.add_argument('--bins', default=10, help='Histogram bins', type=int)
+parser.add_argument('--outfile', help='Also write the recommendation to this JSON file')
+args = parser.parse_args()
+
+files = {'train': args.train, 'valid': args.valid, 'test': args.test}
+files = [(split, files[split]) for split in ['train', 'valid', 'test'] if files[split] is not None]
+
+
+def embedding_vocab(filename, words):
+    # The models zero the counts of the known words they find in the file, and add the rest to their vocab with
+    # random vectors, so the words in the file are those left at zero
+    counts = Counter(words)
+    load_embeddings(filename, counts)
+    return set(w for w, count in counts.items() if count == 0)
+
+
+def report_oov(name, words, vocab, against):
+    token_rate, type_rate = oov_rate(words, vocab)
+    print('  %s OOV vs %s: %.2f%% of tokens, %.2f%% of types' % (name, against, 100 * token_rate, 100 * type_rate))
+
+
+def report_waste(profile, batchsz, current, recommended, edges):
+    print('Projected padding of %s on train, batchsz %d' % (profile.name, batchsz))
+    for label, mxlen, trim, buckets in [('pad to %d' % current, current, False, None),
+                                        ('pad to %d' % recommended, recommended, False, None),
+                                        ('trim, max %d' % recommended, recommended, True, None),
+                                        ('buckets, max %d' % recommended, recommended, False, edges)]:
+        print('  %-20s %6.2f%% padding, %.2f%% of examples truncated'
+              % (label, 100 * profile.waste(batchsz, mxlen, trim, buckets), 100 * profile.truncated(mxlen)))
+
+
+def recommend_lengths(profile):
+    mxlen = profile.length_at(args.percentile)
+    edges = [int(edge) for edge in bucket_edges(np.minimum(profile.lengths, mxlen), args.buckets)]
+    return mxlen, edges
+
+
+def recommend_word_length(profile):
+    mxwlen = profile.length_at(args.wpercentile)
+    print('Projected padding of %s on train' % profile.name)
+    for label, maxw in [('pad to %d' % args.mxwlen, args.mxwlen), ('pad to %d' % mxwlen, mxwlen)]:
+        print('  %-20s %6.2f%% padding, %.2f%% of tokens truncated'
+              % (label, 100 * profile.waste(1, maxw), 100 * profile.truncated(maxw)))
+    return mxwlen
+
+
+recommended = {}
+
+if args.task == 'classify':
+    clean_fn = TSVSeqLabelReader.do_clean if args.clean else None
+    profiles = {split: profile_classify(filename, clean_fn, args.zeropadding) for split, filename in files}
+    vocab = embedding_vocab(args.embed, profiles['train'][1]) if args.embed else profiles['train'][1]
+    for split, _ in files:
+        lengths, words = profiles[split]
+        print('[%s]' % split)
+        print(lengths.report(args.bins))
+        if args.embed or split != 'train':
+            report_oov('word', words, vocab, 'embeddings' if args.embed else 'train')
+    lengths = profiles['train'][0]
+    mxlen, edges = recommend_lengths(lengths)
+    report_waste(lengths, args.batchsz, 100 if args.mxlen is None else args.mxlen, mxlen, edges)
+    recommended = {'mxlen': mxlen, 'buckets': edges}
+
+elif args.task == 'tagger':
+    word_trans_fn = None if not args.web_cleanup else CONLLSeqReader.web_cleanup
+    profiles = {split: profile_tagger(filename, word_trans_fn) for split, filename in files}
+    vocab = embedding_vocab(args.embed, profiles['train'][2]) if args.embed else profiles['train'][2]
+    for split, _ in files:
+        lengths, word_lengths, words = profiles[split]
+        print('[%s]' % split)
+        print(lengths.report(args.bins))
+        print(word_lengths.report(args.bins))
+        if args.embed or split != 'train':
+            report_oov('word', words, vocab, 'embeddings' if args.embed else 'train')
+    lengths, word_lengths, _ = profiles['train']
+    mxlen, edges = recommend_lengths(lengths)
+    report_waste(lengths, args.batchsz, lengths.length_at(100) if args.mxlen is None else args.mxlen, mxlen, edges)
+    mxwlen = recommend_word_length(word_lengths)
+    recommended = {'mxlen': mxlen, 'mxwlen': mxwlen, 'buckets': edges}
+
+elif args.task == 'seq2seq':
+    if args.pair_suffix is not None:
+        reader = MultiFileParallelCorpusReader(args.pair_suffix[0], args.pair_suffix[1])
+    else:
+        reader = TSVParallelCorpusReader()
+    profiles = {split: profile_seq2seq(reader, filename) for split, filename in files}
+    _, _, src_words, dst_words = profiles['train']
+    src_vocab = embedding_vocab(args.embed1, src_words) if args.embed1 else src_words
+    dst_vocab = embedding_vocab(args.embed2, dst_words) if args.embed2 else dst_words
+    for split, _ in files:
+        src_lengths, dst_lengths, src_words, dst_words = profiles[split]
+        print('[%s]' % split)
+        print(src_lengths.report(args.bins))
+        print(dst_lengths.report(args.bins))
+        if args.embed1 or split != 'train':
+            report_oov('source', src_words, src_vocab, 'embeddings' if args.embed1 else 'train')
+        if args.embed2 or split != 'train':
+            report_oov('target', dst_words, dst_vocab, 'embeddings' if args.embed2 else 'train')
+    # Both sides are truncated to the same mxlen, and buckets go by the longer side of each pair
+    src_lengths, dst_lengths, _, _ = profiles['train']
+    lengths = LengthProfile('pair length', np.maximum(src_lengths.lengths, dst_lengths.lengths))
+    mxlen, edges = recommend_lengths(lengths)
+    report_waste(lengths, args.batchsz, 1000 if args.mxlen is None else args.mxlen, mxlen, edges)
+    recommended = {'mxlen': mxlen, 'buckets': edges}
+
+else:
+    profiles = {split: profile_lm(filename) for split, filename in files}
+    vocab = embedding_vocab(args.embed, profiles['train'][1]) if args.embed else profiles['train'][1]
+    for split, _ in files:
+        word_lengths, words = profiles[split]
+        print('[%s]' % split)
+        print(word_lengths.report(args.bins))
+        if args.embed or split != 'train':
+            report_oov('word', words, vocab, 'embeddings' if args.embed else 'train')
+    mxwlen = recommend_word_length(profiles['train'][0])
+    recommended = {'mxwlen': mxwlen}
+
+flags = []
+for name in ['mxlen', 'mxwlen', 'buckets']:
+    if name in recommended:
+        value = recommended[name]
+        flags.append('--%s %s' % (name, ' '.join(str(v) for v in value) if isinstance(value, list) else value))
+print('Recommended: %s' % ' '.join(flags))
+
+if args.outfile is not None:
+    with open(args.outfile, 'w') as f:
+        json.dump(recommended, f, indent=2)
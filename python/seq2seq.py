@@ -5,14 +5,20 @@ parser = argparse.ArgumentParser(description='Sequence to sequence learning')
 parser.add_argument('--visdom', help='Turn on visdom reporting', type=bool, default=False)
 parser.add_argument('--eta', default=0.001, help='Initial learning rate.', type=float)
 parser.add_argument('--mom', default=0.9, help='Momentum (if SGD)', type=float)
-parser.add_argument('--embed1', help='Word2Vec embeddings file (1)')
-parser.add_argument('--embed2', help='Word2Vec embeddings file (2)')
+parser.add_argument('--embed1', help='Word2Vec binary or GloVe/fastText text embeddings file (1)')
+parser.add_argument('--embed2', help='Word2Vec binary or GloVe/fastText text embeddings file (2)')
+parser.add_argument('--embed_cache', default=None, help='Directory to cache the vectors kept from the embeddings in, so later runs load them at once')
+parser.add_argument('--embed_cache_full_hash', default=False, action='store_true', help='Recognize cached embeddings by a hash of the whole file, rather than its size, modification time and sampled blocks')
+parser.add_argument('--share_embed', default=None, help='Hold the embedding weights in a memory-mapped file in this directory (e.g. /dev/shm), shared by every process that builds the same weights')
+parser.add_argument('--embed_storage', default='float32', choices=['float32', 'float16', 'int8'], help='Hold the embedding tables as float16, or as int8 with a scale per row (frozen PyTorch tables stay that way)')
+parser.add_argument('--seed', default=None, type=int, help='Seed numpy\'s random number generator, so that every run draws the same random vectors (required by --share_embed)')
 parser.add_argument('--rnntype', default='lstm', help='(lstm|gru)')
 parser.add_argument('--optim', default='adam', help='Optim method')
 parser.add_argument('--dropout', default=0.5, help='Dropout probability', type=float)
 parser.add_argument('--train', help='Training file')
 parser.add_argument('--valid', help='Validation file')
 parser.add_argument('--test', help='Test file')
+parser.add_argument('--dataset', help='Preprocessed dataset directory (see preprocess.py), instead of train/test')
 parser.add_argument('--unif', default=0.25, help='Initializer bounds for embeddings', type=float)
 parser.add_argument('--epochs', default=60, help='Number of epochs', type=int)
 parser.add_argument('--batchsz', default=50, help='Batch size', type=int)
@@ -34,8 +40,21 @@ parser.add_argument('--pdrop', default=0.5, help='Dropout', type=float)
 parser.add_argument('--backend', default='tf', help='Deep Learning Framework backend')
 parser.add_argument('--pair_suffix', default=None, nargs='+', help='list of suffixes to give if parallel corpora')
 parser.add_argument('--vocab', default=None, help='vocab (basename) file to give if it exists')
+parser.add_argument('--vocab_workers', default=1, help='Processes to use for building the vocabulary, and for parsing text embeddings', type=int)
+parser.add_argument('--buckets', default=None, nargs='+', type=int, help='Batch examples of similar length together: either a number of buckets, or the bucket edges')
+parser.add_argument('--prefetch', default=0, type=int, help='Build this many batches ahead on a background thread')
+parser.add_argument('--max_tokens', default=None, type=int, help='Instead of batchsz examples, batch as many as fit in this many (padded) tokens')
+parser.add_argument('--workers', default=1, type=int, help='Build batches in this many processes')
 args = parser.parse_args()
+if args.share_embed is not None and args.embed_storage != 'float32':
+    parser.error('--share_embed cannot be combined with --embed_storage')
+if args.share_embed is not None and args.seed is None:
+    parser.error('--share_embed requires --seed, or each process draws different random vectors and shares nothing')
+if args.seed is not None:
+    np.random.seed(args.seed)
 gpu = not args.nogpu
+buckets = None if args.buckets is None else args.buckets[0] if len(args.buckets) == 1 else args.buckets
+batch_args = {'buckets': buckets, 'max_tokens': args.max_tokens, 'workers': args.workers}
 
 args.reporting = setup_reporting(args.visdom)
 
@@ -51,7 +70,7 @@ if args.backend == 'pytorch':
     show_ex_fn = show_examples_pytorch
     alloc_fn = long_0_tensor_alloc
     shape_fn = tensor_shape
-    src_vec_trans = None if args.attn else tensor_reverse_2nd
+    src_vec_trans = None if args.attn else reverse_2nd
     trim = True
 else:
     from baseline.tf import *
@@ -62,7 +81,13 @@ else:
     src_vec_trans = None if args.attn else reverse_2nd
     trim = False
 
-if args.pair_suffix is not None and args.vocab is not None:
+if args.dataset is not None:
+    print('Reading preprocessed dataset')
+    dataset = Dataset(args.dataset)
+    if dataset.params['max_sentence_length'] != args.mxlen:
+        raise ValueError('Dataset was preprocessed with mxlen %d' % dataset.params['max_sentence_length'])
+    vocab1, vocab2 = dataset.vocabs['src'], dataset.vocabs['dst']
+elif args.pair_suffix is not None and args.vocab is not None:
     print('Reading parallel file corpus')
     reader = MultiFileParallelCorpusReader(args.pair_suffix[0], args.pair_suffix[1],
                                            args.mxlen, vec_alloc=alloc_fn, trim=trim,
@@ -70,20 +95,38 @@ if args.pair_suffix is not None and args.vocab is not None:
     vocab_list = [args.vocab]
 else:
     print('Reading tab-separated corpus')
-    reader = TSVParallelCorpusReader(args.mxlen, vec_alloc=alloc_fn, trim=trim, src_vec_trans=src_vec_trans)
+    reader = TSVParallelCorpusReader(args.mxlen, trim=trim, src_vec_trans=src_vec_trans)
     vocab_list = [args.train, args.test]
 
-vocab1, vocab2 = reader.build_vocabs(vocab_list)
+if args.dataset is None:
+    vocab1, vocab2 = reader.build_vocabs(vocab_list, workers=args.vocab_workers)
 
-embed1 = Word2VecModel(args.embed1, vocab1, unif_weight=args.unif) \
+embed1 = load_embeddings(args.embed1, vocab1, unif_weight=args.unif, cache_dir=args.embed_cache,
+                         full_hash=args.embed_cache_full_hash, workers=args.vocab_workers) \
     if args.embed1 else RandomInitVecModel(args.dsz, vocab1, unif_weight=args.unif)
 
-embed2 = Word2VecModel(args.embed2, vocab2, unif_weight=args.unif) \
+embed2 = load_embeddings(args.embed2, vocab2, unif_weight=args.unif, cache_dir=args.embed_cache,
+                         full_hash=args.embed_cache_full_hash, workers=args.vocab_workers) \
     if args.embed2 else RandomInitVecModel(args.dsz, vocab1, unif_weight=args.unif)
 
-ts = reader.load(args.train, embed1.vocab, embed2.vocab, args.batchsz, shuffle=True)
-es = reader.load(args.test, embed1.vocab, embed2.vocab, args.batchsz)
+if args.share_embed is not None:
+    embed1.share(args.share_embed)
+    embed2.share(args.share_embed)
+elif args.embed_storage != 'float32':
+    embed1.quantize(args.embed_storage)
+    embed2.quantize(args.embed_storage)
+
+if args.dataset is not None:
+    dataset.check_index('src', embed1.vocab)
+    dataset.check_index('dst', embed2.vocab)
+    ts = dataset.load('train', args.batchsz, shuffle=True, trim=trim, src_vec_trans=src_vec_trans, **batch_args)
+    es = dataset.load('test', args.batchsz, trim=trim, src_vec_trans=src_vec_trans, **batch_args)
+else:
+    ts = reader.load(args.train, embed1.vocab, embed2.vocab, args.batchsz, shuffle=True, **batch_args)
+    es = reader.load(args.test, embed1.vocab, embed2.vocab, args.batchsz, **batch_args)
 print('Finished loading datasets')
+if args.prefetch > 0:
+    ts, es = [PrefetchDataFeed(feed, args.prefetch) for feed in (ts, es)]
 rlut1 = revlut(embed1.vocab)
 rlut2 = revlut(embed2.vocab)
 
@@ -4,14 +4,20 @@ from baseline import *
 parser = argparse.ArgumentParser(description='Sequence tagger for sentences')
 parser.add_argument('--visdom', help='Turn on visdom reporting', type=bool, default=False)
 parser.add_argument('--eta', default=0.01, type=float)
-parser.add_argument('--embed', default=None, help='Word2Vec embeddings file')
+parser.add_argument('--embed', default=None, help='Word2Vec binary or GloVe/fastText text embeddings file')
+parser.add_argument('--embed_cache', default=None, help='Directory to cache the vectors kept from the embeddings in, so later runs load them at once')
+parser.add_argument('--embed_cache_full_hash', default=False, action='store_true', help='Recognize cached embeddings by a hash of the whole file, rather than its size, modification time and sampled blocks')
+parser.add_argument('--share_embed', default=None, help='Hold the embedding weights in a memory-mapped file in this directory (e.g. /dev/shm), shared by every process that builds the same weights')
+parser.add_argument('--embed_storage', default='float32', choices=['float32', 'float16', 'int8'], help='Hold the embedding tables as float16, or as int8 with a scale per row (frozen PyTorch tables stay that way)')
+parser.add_argument('--seed', default=None, type=int, help='Seed numpy\'s random number generator, so that every run draws the same random vectors (required by --share_embed)')
 parser.add_argument('--optim', default='adadelta', help='Optim method')
 parser.add_argument('--decay', default=0, help='LR decay', type=float)
 parser.add_argument('--mom', default=0.9, help='SGD momentum', type=float)
 parser.add_argument('--dropout', default=0.5, help='Dropout probability', type=float)
-parser.add_argument('--train', help='Training file', required=True)
+parser.add_argument('--train', help='Training file')
 parser.add_argument('--valid', help='Validation file')
-parser.add_argument('--test', help='Test file', required=True)
+parser.add_argument('--test', help='Test file')
+parser.add_argument('--dataset', help='Preprocessed dataset directory (see preprocess.py), instead of train/valid/test')
 parser.add_argument('--rnntype', default='blstm', help='RNN type')
 parser.add_argument('--layers', default=1, help='The depth of stacked RNNs', type=int)
 parser.add_argument('--outdir', default='out', help='Directory to put the output')
@@ -35,8 +41,24 @@ parser.add_argument('--crf', default=False, help='Use a CRF on top', type=bool)
 parser.add_argument('--early_stopping_metric', default='f1', help='Metric for early stopping. For IOB tagging use f1')
 parser.add_argument('--web_cleanup', default=False, help='Do cleanup of web tokens?', type=bool)
 parser.add_argument('--backend', default='tf', help='Default Deep Learning Framework')
+parser.add_argument('--vocab_workers', default=1, help='Processes to use for building the vocabulary, and for parsing text embeddings', type=int)
+parser.add_argument('--buckets', default=None, nargs='+', type=int, help='Batch examples of similar length together: either a number of buckets, or the bucket edges')
+parser.add_argument('--prefetch', default=0, type=int, help='Build this many batches ahead on a background thread')
+parser.add_argument('--max_tokens', default=None, type=int, help='Instead of batchsz examples, batch as many as fit in this many (padded) tokens')
+parser.add_argument('--workers', default=1, type=int, help='Build batches in this many processes')
+parser.add_argument('--lazy', default=False, action='store_true', help='Index the train and valid files and only read sentences as batches need them')
 args = parser.parse_args()
+if args.dataset is None and (args.train is None or args.test is None):
+    parser.error('Either --dataset or both --train and --test are required')
+if args.share_embed is not None and args.embed_storage != 'float32':
+    parser.error('--share_embed cannot be combined with --embed_storage')
+if args.share_embed is not None and args.seed is None:
+    parser.error('--share_embed requires --seed, or each process draws different random vectors and shares nothing')
+if args.seed is not None:
+    np.random.seed(args.seed)
 gpu = not args.nogpu
+buckets = None if args.buckets is None else args.buckets[0] if len(args.buckets) == 1 else args.buckets
+batch_args = {'buckets': buckets, 'max_tokens': args.max_tokens, 'workers': args.workers}
 
 
 args.reporting = setup_reporting(args.visdom)
@@ -52,9 +74,13 @@ else:
     if args.backend == 'tf':
         import baseline.tf.tagger as tagger
         trim = False
-word_trans_fn = None if not args.web_cleanup else CONLLSeqReader.web_cleanup
-reader = CONLLSeqReader(args.mxlen, args.mxwlen, word_trans_fn=word_trans_fn, vec_alloc=vec_alloc, vec_shape=vec_shape, trim=trim)
-vocab_ch, vocab_word = reader.build_vocab([args.train, args.test, args.valid])
+if args.dataset is not None:
+    dataset = Dataset(args.dataset)
+    vocab_ch, vocab_word = dataset.vocabs['char'], dataset.vocabs['word']
+else:
+    word_trans_fn = None if not args.web_cleanup else CONLLSeqReader.web_cleanup
+    reader = CONLLSeqReader(args.mxlen, args.mxwlen, word_trans_fn=word_trans_fn, vec_alloc=vec_alloc, vec_shape=vec_shape, trim=trim)
+    vocab_ch, vocab_word = reader.build_vocab([args.train, args.test, args.valid], workers=args.vocab_workers)
 
 
 # Vocab LUTs
@@ -63,26 +89,58 @@ char_vocab = None
 
 word_vec = None
 if args.embed:
-    word_vec = Word2VecModel(args.embed, vocab_word, unif_weight=args.unif)
+    word_vec = load_embeddings(args.embed, vocab_word, unif_weight=args.unif, cache_dir=args.embed_cache,
+                               full_hash=args.embed_cache_full_hash, workers=args.vocab_workers)
     word_vocab = word_vec.vocab
 
 char_vec = RandomInitVecModel(args.charsz, vocab_ch, unif_weight=args.unif)
 char_vocab = char_vec.vocab
 print(char_vocab)
 
-ts, _ = reader.load(args.train, word_vocab, char_vocab, args.batchsz, shuffle=True)
-print('Loaded training data')
+if args.share_embed is not None:
+    if word_vec is not None:
+        word_vec.share(args.share_embed)
+    char_vec.share(args.share_embed)
+elif args.embed_storage != 'float32':
+    if word_vec is not None:
+        word_vec.quantize(args.embed_storage)
+    char_vec.quantize(args.embed_storage)
+
+if args.dataset is not None:
+    dataset.check_index('word', word_vocab)
+    dataset.check_index('char', char_vocab)
+    ts = dataset.load('train', args.batchsz, shuffle=True, trim=trim, **batch_args)
+    vs = dataset.load('valid', args.batchsz, trim=trim, **batch_args)
+    es = dataset.load('test', 2, trim=trim, **batch_args)
+    print('Loaded preprocessed data')
+
+    args.maxs = dataset.params['max_sentence_length']
+    args.maxw = dataset.params['max_word_length']
+    label2index = dataset.label2index
+else:
+    if args.lazy:
+        ts = reader.load_lazy(args.train, word_vocab, char_vocab, args.batchsz, shuffle=True, **batch_args)
+    else:
+        ts, _ = reader.load(args.train, word_vocab, char_vocab, args.batchsz, shuffle=True, **batch_args)
+    print('Loaded training data')
+
+    if args.lazy:
+        vs = reader.load_lazy(args.valid, word_vocab, char_vocab, args.batchsz, **batch_args)
+    else:
+        vs, _ = reader.load(args.valid, word_vocab, char_vocab, args.batchsz, **batch_args)
+    print('Loaded valid data')
 
-vs, _ = reader.load(args.valid, word_vocab, char_vocab, args.batchsz)
-print('Loaded valid data')
+    es, txts = reader.load(args.test, word_vocab, char_vocab, 2, **batch_args)
+    print('Loaded test data')
 
-es, txts = reader.load(args.test, word_vocab, char_vocab, 2)
-print('Loaded test data')
+    args.maxs = reader.max_sentence_length
+    args.maxw = reader.max_word_length
+    label2index = reader.label2index
 
-args.maxs = reader.max_sentence_length
-args.maxw = reader.max_word_length
+if args.prefetch > 0:
+    ts, vs, es = [PrefetchDataFeed(feed, args.prefetch) for feed in (ts, vs, es)]
 
-model = tagger.create_model(reader.label2index, word_vec, char_vec, **vars(args))
+model = tagger.create_model(label2index, word_vec, char_vec, **vars(args))
 
 tagger.fit(model, ts, vs, es, **vars(args))
 
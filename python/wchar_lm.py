@@ -1,5 +1,6 @@
 from baseline import *
 import argparse
+import os
 
 def num_steps_per_epoch(num_examples, nbptt, batchsz):
     rest = num_examples // batchsz
@@ -9,14 +10,20 @@ def num_steps_per_epoch(num_examples, nbptt, batchsz):
 parser = argparse.ArgumentParser(description='Language Modeler')
 parser.add_argument('--visdom', help='Turn on visdom reporting', type=bool, default=False)
 parser.add_argument('--eta', default=1, help='Initial learning rate', type=float)
-parser.add_argument('--embed', default=None, help='Word2Vec embeddings file')
+parser.add_argument('--embed', default=None, help='Word2Vec binary or GloVe/fastText text embeddings file')
+parser.add_argument('--embed_cache', default=None, help='Directory to cache the vectors kept from the embeddings in, so later runs load them at once')
+parser.add_argument('--embed_cache_full_hash', default=False, action='store_true', help='Recognize cached embeddings by a hash of the whole file, rather than its size, modification time and sampled blocks')
+parser.add_argument('--share_embed', default=None, help='Hold the embedding weights in a memory-mapped file in this directory (e.g. /dev/shm), shared by every process that builds the same weights')
+parser.add_argument('--embed_storage', default='float32', choices=['float32', 'float16', 'int8'], help='Hold the embedding tables as float16, or as int8 with a scale per row (frozen PyTorch tables stay that way)')
+parser.add_argument('--seed', default=None, type=int, help='Seed numpy\'s random number generator, so that every run draws the same random vectors (required by --share_embed)')
 parser.add_argument('--optim', default='sgd', help='Optim method')
 parser.add_argument('--decay', default=0, help='LR decay', type=float)
 parser.add_argument('--mom', default=0, help='SGD momentum', type=float)
 parser.add_argument('--dropout', default=0.5, help='Dropout probability', type=float)
-parser.add_argument('--train', help='Training file', required=True)
+parser.add_argument('--train', help='Training file')
 parser.add_argument('--valid', help='Validation file')
-parser.add_argument('--test', help='Test file', required=True)
+parser.add_argument('--test', help='Test file')
+parser.add_argument('--dataset', help='Preprocessed dataset directory (see preprocess.py), instead of train/valid/test')
 parser.add_argument('--rnntype', default='lstm', help='RNN type')
 parser.add_argument('--layers', default=2, help='The depth of stacked RNNs', type=int)
 parser.add_argument('--outdir', default='out', help='Directory to put the output')
@@ -42,7 +49,18 @@ parser.add_argument('--start_decay_epoch', default=6, type=int, help='At what ep
 parser.add_argument('--decay_rate', default=1.2, type=float, help='Learning rate decay')
 parser.add_argument('--decay_type', default='zaremba', help='What learning rate decay schedule')
 parser.add_argument('--backend', default='tf', help='Default Deep Learning Framework')
+parser.add_argument('--vocab_workers', default=1, help='Processes to use for building the vocabulary, and for parsing text embeddings', type=int)
+parser.add_argument('--prefetch', default=0, type=int, help='Build this many batches ahead on a background thread')
+parser.add_argument('--stream_dir', default=None, help='Write the indexed train/valid/test words to this directory and memory-map them, instead of holding them in memory')
 args = parser.parse_args()
+if args.dataset is None and (args.train is None or args.test is None):
+    parser.error('Either --dataset or both --train and --test are required')
+if args.share_embed is not None and args.embed_storage != 'float32':
+    parser.error('--share_embed cannot be combined with --embed_storage')
+if args.share_embed is not None and args.seed is None:
+    parser.error('--share_embed requires --seed, or each process draws different random vectors and shares nothing')
+if args.seed is not None:
+    np.random.seed(args.seed)
 
 
 args.reporting = setup_reporting(args.visdom)
@@ -50,8 +68,15 @@ args.reporting = setup_reporting(args.visdom)
 if args.backend == 'tf':
     import baseline.tf.lm as lm
 
-reader = PTBSeqReader(args.mxwlen, args.nbptt)
-vocab_ch, vocab_word, num_words = reader.build_vocab([args.train, args.valid, args.test])
+if args.dataset is not None:
+    dataset = Dataset(args.dataset)
+    vocab_ch, vocab_word = dataset.vocabs['char'], dataset.vocabs['word']
+    for split in ['train', 'valid', 'test']:
+        dataset.check_split(split)
+    num_words = [dataset.params['num_words'][split] for split in ['train', 'valid', 'test']]
+else:
+    reader = PTBSeqReader(args.mxwlen, args.nbptt)
+    vocab_ch, vocab_word, num_words = reader.build_vocab([args.train, args.valid, args.test], workers=args.vocab_workers)
 
 
 # Vocab LUTs
@@ -61,7 +86,8 @@ char_vocab = None
 # No matter what we will create a vocab for words, since that is what we are emitting
 word_vec = None
 if args.embed and args.char is False:
-    word_vec = w2v.Word2VecModel(args.embed, vocab_word, args.unif)
+    word_vec = load_embeddings(args.embed, vocab_word, args.unif, cache_dir=args.embed_cache,
+                               full_hash=args.embed_cache_full_hash, workers=args.vocab_workers)
     word_vocab = word_vec.vocab
 # TODO: Fix this to be a boolean for use word vectors
 else:
@@ -72,18 +98,45 @@ else:
 char_vec = w2v.RandomInitVecModel(args.charsz, vocab_ch, args.unif)
 char_vocab = char_vec.vocab
 
-ts = reader.load(args.train, word_vocab, char_vocab, num_words[0], batchsz=args.batchsz)
-print('Loaded training data')
+if args.share_embed is not None:
+    word_vec.share(args.share_embed)
+    char_vec.share(args.share_embed)
+elif args.embed_storage != 'float32':
+    word_vec.quantize(args.embed_storage)
+    char_vec.quantize(args.embed_storage)
+
+if args.dataset is not None:
+    dataset.check_index('word', word_vocab)
+    dataset.check_index('char', char_vocab)
+    ts = dataset.load('train', args.batchsz, nbptt=args.nbptt)
+    vs = dataset.load('valid', args.batchsz, nbptt=args.nbptt)
+    es = dataset.load('test', args.batchsz, nbptt=args.nbptt)
+    print('Loaded preprocessed data')
+    args.maxw = dataset.params['max_word_length']
+elif args.stream_dir is not None:
+    if not os.path.exists(args.stream_dir):
+        os.makedirs(args.stream_dir)
+    ts, vs, es = [reader.load_stream(filename, word_vocab, char_vocab, args.batchsz,
+                                     os.path.join(args.stream_dir, '%s.ids' % split), workers=args.vocab_workers)
+                  for split, filename in zip(['train', 'valid', 'test'], [args.train, args.valid, args.test])]
+    print('Streaming data from %s' % args.stream_dir)
+    args.maxw = reader.max_word_length
+else:
+    ts = reader.load(args.train, word_vocab, char_vocab, num_words[0], batchsz=args.batchsz)
+    print('Loaded training data')
+
+    vs = reader.load(args.valid, word_vocab, char_vocab, num_words[1], batchsz=args.batchsz)
+    print('Loaded validation data')
 
-vs = reader.load(args.valid, word_vocab, char_vocab, num_words[1], batchsz=args.batchsz)
-print('Loaded validation data')
+    es = reader.load(args.test, word_vocab, char_vocab, num_words[2], batchsz=args.batchsz)
+    args.maxw = reader.max_word_length
 
-es = reader.load(args.test, word_vocab, char_vocab, num_words[2], batchsz=args.batchsz)
+if args.prefetch > 0:
+    ts, vs, es = [PrefetchDataFeed(feed, args.prefetch) for feed in (ts, vs, es)]
 
 print('Using %d examples for training' % num_words[0])
 print('Using %d examples for validation' % num_words[1])
 print('Using %d examples for test' % num_words[2])
-args.maxw = reader.max_word_length
 model = lm.create_model(word_vec, char_vec, **vars(args))
 steps_per_epoch = num_steps_per_epoch(num_words[0], args.nbptt, args.batchsz)
 first_range = int(args.start_decay_epoch * steps_per_epoch)